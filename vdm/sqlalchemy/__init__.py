@@ -37,8 +37,9 @@ __all__ = [
         'make_table_stateful', 'make_table_revisioned',
         'make_State', 'make_Revision',
         'StatefulObjectMixin', 'RevisionedObjectMixin',
-        'Revisioner', 'modify_base_object_mapper', 'create_object_version',
+        'Revisioner', 'SessionRevisioner', 'modify_base_object_mapper', 'create_object_version',
         'add_stateful_versioned_m2m', 'add_stateful_versioned_m2m_on_version',
+        'prefetch_as_of',
         'Repository'
         ]
 
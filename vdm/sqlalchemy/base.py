@@ -2,19 +2,64 @@ from datetime import datetime
 import difflib
 import uuid
 import logging
-import weakref
+import operator
+import threading
+from collections import Counter
 
 from sqlalchemy import *
-from sqlalchemy.orm.attributes import get_history, PASSIVE_OFF
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
+from sqlalchemy.orm.attributes import instance_state, NO_VALUE
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from sqlalchemy.orm.base import instance_str
 from sqlalchemy import __version__ as sqav
 
 from sqla import SQLAlchemyMixin
 from sqla import copy_column, copy_table_columns, copy_table
+import cache
 
 make_uuid = lambda: unicode(uuid.uuid4())
 logger = logging.getLogger('vdm')
 
+_missing = object()
+
+# counters of how (historical) reads were answered e.g. stats['get_as_of.head']
+stats = Counter()
+
 ## -------------------------------------
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+class _ContextLocal(object):
+    '''Stand in for contextvars.ContextVar (which needs python 3.7) which
+    is local to the current thread.
+
+    As with ContextVar use as: token = var.set(value) ... var.reset(token)
+    '''
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self.default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+if contextvars is not None:
+    _context_revision = contextvars.ContextVar('vdm_revision', default=None)
+else:
+    _context_revision = _ContextLocal('vdm_revision')
+
+
 class SQLAlchemySession(object):
     '''Handle setting/getting attributes on the SQLAlchemy session.
     
@@ -37,27 +82,63 @@ class SQLAlchemySession(object):
     def getattr(self, session, attr):
         return getattr(session, attr)
 
+    @classmethod
+    def instance(self, session):
+        '''Return the actual Session object (session may be a ScopedSession).'''
+        if isinstance(session, sqlalchemy.orm.scoping.ScopedSession):
+            return session()
+        return session
+
     # make explicit to avoid errors from typos (no attribute defns in python!)
     @classmethod
     def set_revision(self, session, revision):
+        if getattr(self.instance(session), 'revision', None) is not revision:
+            AsOfCache.discard(self.instance(session))
         self.setattr(session, 'HEAD', True)
         self.setattr(session, 'revision', revision)
         if revision.id is None:
             # make uuid here so that if other objects in this session are flushed
             # at the same time they know thier revision id
             revision.id = make_uuid()
-            # there was a begin_nested here but that just caused flush anyway.
-            session.add(revision)
-            session.flush()
+            # nobody else can have written object revisions for a uuid we
+            # have only just made up
+            RevisionWriteLog.start(self.instance(session), revision.id)
+        # NB: revision is not added to the session (nor flushed) here. That
+        # is left to the first flush which makes a versioned change (see
+        # _before_flush_add_revision) so if nothing changes no revision is
+        # written at all.
 
     @classmethod
     def get_revision(self, session):
         '''Get revision on current Session/session.
+
+        A revision set for the current context (see set_context_revision)
+        takes precedence over the one on the session.
         
         NB: will return None if not set
         '''
+        current = _context_revision.get()
+        if current is not None:
+            revision, for_session = current
+            if for_session is None or session is None or \
+                    self.instance(session) is for_session:
+                return revision
         return getattr(session, 'revision', None)
 
+    @classmethod
+    def set_context_revision(self, revision, session=None):
+        '''Set the revision for the current context (thread or asyncio task)
+        whatever session is used or, if `session` is given, for that session
+        only (other sessions keep their own revision).
+
+        @return: token to pass to reset_context_revision.
+        '''
+        return _context_revision.set((revision, self.instance(session)))
+
+    @classmethod
+    def reset_context_revision(self, token):
+        _context_revision.reset(token)
+
     @classmethod
     def set_not_at_HEAD(self, session):
         self.setattr(session, 'HEAD', False)
@@ -130,12 +211,36 @@ def make_table_revisioned(base_table):
     logger.warn('make_table_revisioned is deprecated: use make_revisioned_table')
     return make_revisioned_table(base_table)
 
-def make_revisioned_table(base_table):
+# columns of the (optional) valid time layout of revision tables
+VALID_TIME_COLUMNS = ('valid_from', 'valid_to', 'previous_revision_id')
+
+def has_valid_time(revision_table):
+    return 'valid_to' in revision_table.c
+
+# max number of ids to put into a single IN clause when looking up many
+# objects (or their revisions) at once (e.g. get_many_as_of)
+IN_CLAUSE_CHUNK = 500
+
+def has_revision_timestamp(revision_table):
+    return 'revision_timestamp' in revision_table.c
+
+def make_revisioned_table(base_table, valid_time=False,
+        revision_timestamp=False):
     '''Modify base_table and create correponding revision table.
 
     # TODO: (complex) support for complex primary keys on continuity. 
     # Search for "composite foreign key sqlalchemy" for helpful info
 
+    @param valid_time: add valid_from, valid_to (timestamps of the revision
+        which made this object revision and of the one which replaced it) and
+        previous_revision_id columns to the revision table. These are kept up
+        to date when object revisions are written and make finding the
+        version of an object at a given time a single (indexed) lookup. For
+        existing histories see Repository.backfill_valid_time.
+    @param revision_timestamp: add a revision_timestamp column (a copy of
+        the timestamp of the object revision's revision) so history queries
+        do not need to join to the revision table. See
+        Repository.backfill_revision_timestamp for existing histories.
     @return revision table.
     '''
     base_table.append_column(
@@ -171,6 +276,16 @@ def make_revisioned_table(base_table):
         if col.name == 'revision_id':
             col.primary_key = True
             newtable.primary_key.columns.add(col)
+    if valid_time:
+        newtable.append_column(Column('valid_from', DateTime))
+        newtable.append_column(Column('valid_to', DateTime))
+        newtable.append_column(Column('previous_revision_id', UnicodeText))
+        Index('%s_valid_idx' % newtable.name, newtable.c.continuity_id,
+                newtable.c.valid_from)
+    if revision_timestamp:
+        newtable.append_column(Column('revision_timestamp', DateTime))
+        Index('%s_timestamp_idx' % newtable.name, newtable.c.continuity_id,
+                newtable.c.revision_timestamp)
     return newtable
 
 
@@ -191,6 +306,11 @@ class StatefulObjectMixin(object):
         # also support None in case this object is not yet refreshed ...
         return self.state is None or self.state == State.ACTIVE
 
+    @classmethod
+    def active_clause(cls):
+        '''SQL criterion for is_active.'''
+        return or_(cls.state == State.ACTIVE, cls.state == None)
+
 
 class RevisionedObjectMixin(object):
     __ignored_fields__ = ['revision_id']
@@ -198,6 +318,9 @@ class RevisionedObjectMixin(object):
 
     @classmethod
     def revisioned_fields(cls):
+        info = VersionedClassInfo.get(cls)
+        if info is not None:
+            return info.fields
         table = sqlalchemy.orm.class_mapper(cls).mapped_table
         fields = [ col.name for col in table.c if col.name not in
                 cls.__ignored_fields__ ]
@@ -224,10 +347,73 @@ class RevisionedObjectMixin(object):
             SQLAlchemySession.set_revision(sess, revision)
             SQLAlchemySession.set_not_at_HEAD(sess)
         else:
-            revision = SQLAlchemySession.get_revision(sess)
+            # NB: the session's revision (not the context's) as that is what
+            # we are looking at
+            revision = getattr(sess, 'revision', None)
 
         if SQLAlchemySession.at_HEAD(sess):
             return self
+        # historical traversal resolves the same objects over and over
+        cache = AsOfCache.get(sess)
+        key = (self.__revision_class__, self.id, revision.id)
+        if key in cache.results:
+            stats['get_as_of.cache_hit'] += 1
+            return cache.results[key]
+        stats['get_as_of.cache_miss'] += 1
+        out = self._get_as_of(sess, revision)
+        cache.results[key] = out
+        return out
+
+    def _get_as_of(self, sess, revision):
+        view = self._head_view(sess, revision)
+        if view is not None:
+            stats['get_as_of.head'] += 1
+            return view
+        shared = cache.get_cache()
+        if shared is None or not _is_settled(sess, revision):
+            stats['get_as_of.query'] += 1
+            return self._query_as_of(sess, revision)
+        revision_mapper = class_mapper(self.__revision_class__)
+        table_name = revision_mapper.local_table.name
+        key = ('as_of', table_name, self.id, revision.id)
+        rowkey = shared.get(key, _missing)
+        if rowkey is None:
+            stats['get_as_of.shared_hit'] += 1
+            return None
+        if rowkey is not _missing:
+            colvalues = shared.get(rowkey)
+            if colvalues is not None:
+                stats['get_as_of.shared_hit'] += 1
+                return _cached_object(sess, revision_mapper, colvalues)
+        stats['get_as_of.query'] += 1
+        out = self._query_as_of(sess, revision)
+        tags = [('revision', revision.id), ('continuity', table_name, self.id)]
+        if out is None:
+            shared.put(key, None, tags)
+        else:
+            rowkey = _put_row(shared, revision_mapper, out)
+            shared.put(key, rowkey, tags + [('revision', out.revision_id)])
+        _put_row(shared, class_mapper(Revision), revision)
+        return out
+
+    def _query_as_of(self, sess, revision):
+        if has_valid_time(
+                class_mapper(self.__revision_class__).local_table):
+            return self._valid_at(sess, revision.timestamp).first()
+        elif has_revision_timestamp(
+                class_mapper(self.__revision_class__).local_table):
+            revision_class = self.__revision_class__
+            out = sess.query(revision_class).\
+                filter(
+                    revision_class.revision_timestamp <= revision.timestamp
+                ).\
+                filter(
+                    revision_class.continuity_id == self.id
+                ).\
+                order_by(
+                    revision_class.revision_timestamp.desc()
+                )
+            return out.first()
         else:
             revision_class = self.__revision_class__
             # TODO: when dealing with multi-col pks will need to update this
@@ -244,13 +430,210 @@ class RevisionedObjectMixin(object):
                 )
             return out.first()
     
+    def _head_view(self, sess, revision):
+        '''If this (continuity) object has not changed since `revision`
+        return a (transient, so read-only) object revision made from it without
+        going to the database. Otherwise (or if that cannot be told from what
+        is in memory) return None.
+        '''
+        state = instance_state(self)
+        if state.key is None or state.modified or revision is None:
+            return None
+        revision_id = state.dict.get('revision_id')
+        if revision_id is None:
+            return None
+        if revision_id == revision.id:
+            current = revision
+            timestamp = revision.timestamp
+        else:
+            # only if the revision is in the session already
+            key = class_mapper(Revision).identity_key_from_primary_key(
+                    [revision_id])
+            current = sess.identity_map.get(key)
+            if current is None and cache.get_cache() is not None:
+                colvalues = cache.get_cache().get(('row',
+                    class_mapper(Revision).local_table.name, revision_id))
+                if colvalues is not None:
+                    current = _cached_object(sess, class_mapper(Revision),
+                            colvalues)
+            if current is None:
+                return None
+            timestamp = current.__dict__.get('timestamp')
+            if timestamp is None or revision.timestamp is None or \
+                    timestamp > revision.timestamp:
+                return None
+        revision_class = self.__revision_class__
+        revision_table = class_mapper(revision_class).local_table
+        # we do not know previous_revision_id
+        if has_valid_time(revision_table):
+            return None
+        colvalues = {}
+        for key in class_mapper(type(self)).local_table.c.keys():
+            if key not in state.dict:
+                return None
+            colvalues[key] = state.dict[key]
+        colvalues['continuity_id'] = self.id
+        if has_revision_timestamp(revision_table):
+            colvalues['revision_timestamp'] = timestamp
+        # and relations which would have to be loaded
+        revision_mapper = class_mapper(revision_class)
+        relations = {'continuity': self, 'revision': current}
+        for prop in revision_mapper.relationships:
+            if prop.key in relations:
+                continue
+            if prop.key not in state.dict:
+                return None
+            relations[prop.key] = state.dict[prop.key]
+        view = revision_mapper.class_manager.new_instance()
+        for key, value in colvalues.items():
+            set_committed_value(view, key, value)
+        for key, value in relations.items():
+            set_committed_value(view, key, value)
+        return view
+
+    def _valid_at(self, sess, timestamp):
+        '''Query for object revision valid at `timestamp` (valid time
+        layout only).'''
+        revision_class = self.__revision_class__
+        return sess.query(revision_class).filter(
+                revision_class.continuity_id == self.id
+            ).filter(
+                revision_class.valid_from <= timestamp
+            ).filter(or_(
+                revision_class.valid_to == None,
+                revision_class.valid_to > timestamp
+            ))
+
+    @classmethod
+    def get_many_as_of(cls, objects_or_ids, revision, session=None):
+        '''Get many domain objects of this class at `revision` at once.
+
+        Like get_as_of but with one query (per 500 objects) for all of them
+        rather than one per object.
+
+        @param objects_or_ids: domain objects (or their ids).
+        @param session: session to use (default: that of `revision` or of
+            the objects).
+        @return: dict of object revisions keyed by id (None for objects which
+            did not exist at `revision`).
+        '''
+        ids = []
+        sess = session or object_session(revision)
+        for item in objects_or_ids:
+            if isinstance(item, cls):
+                sess = sess or object_session(item)
+                item = item.id
+            ids.append(item)
+        results = dict([ (id_, None) for id_ in ids ])
+        if not ids:
+            return results
+        if sess is None:
+            raise ValueError('No session: revision and objects are not in '
+                    'one so pass session')
+        revision_class = cls.__revision_class__
+        revision_table = class_mapper(revision_class).local_table
+        # greatest (timestamp) per group (continuity)
+        for ii in range(0, len(ids), IN_CLAUSE_CHUNK):
+            chunk = ids[ii:ii+IN_CLAUSE_CHUNK]
+            if has_valid_time(revision_table):
+                q = sess.query(revision_class).filter(
+                        revision_class.continuity_id.in_(chunk)
+                    ).filter(
+                        revision_class.valid_from <= revision.timestamp
+                    ).filter(or_(
+                        revision_class.valid_to == None,
+                        revision_class.valid_to > revision.timestamp
+                    ))
+                for revobj in q:
+                    results[revobj.continuity_id] = revobj
+                continue
+            if has_revision_timestamp(revision_table):
+                # no need to join to the revision table
+                timestamp = revision_table.c.revision_timestamp
+                latest = sess.query(
+                        revision_table.c.continuity_id.label('continuity_id'),
+                        func.max(timestamp).label('timestamp')
+                    )
+                q = sess.query(revision_class)
+            else:
+                timestamp = Revision.timestamp
+                latest = sess.query(
+                        revision_table.c.continuity_id.label('continuity_id'),
+                        func.max(timestamp).label('timestamp')
+                    ).join(Revision,
+                        Revision.id == revision_table.c.revision_id
+                    )
+                q = sess.query(revision_class).join('revision')
+            latest = latest.filter(
+                    timestamp <= revision.timestamp
+                ).filter(
+                    revision_table.c.continuity_id.in_(chunk)
+                ).group_by(revision_table.c.continuity_id).subquery()
+            q = q.join(latest, and_(
+                    revision_class.continuity_id == latest.c.continuity_id,
+                    timestamp == latest.c.timestamp
+                ))
+            for revobj in q:
+                results[revobj.continuity_id] = revobj
+        return results
+
     @property
     def all_revisions(self):
-        allrevs = self.all_revisions_unordered
-        ourcmp = lambda revobj1, revobj2: cmp(revobj1.revision.timestamp,
-                revobj2.revision.timestamp)
-        sorted_revobjs = sorted(allrevs, cmp=ourcmp, reverse=True)
-        return sorted_revobjs
+        '''Object revisions of this object youngest first (see
+        get_revisions).'''
+        if object_session(self) is None:
+            # not in a session so nothing to query
+            allrevs = self.all_revisions_unordered
+            ourcmp = lambda revobj1, revobj2: cmp(revobj1.revision.timestamp,
+                    revobj2.revision.timestamp)
+            return sorted(allrevs, cmp=ourcmp, reverse=True)
+        return self.get_revisions()
+
+    def get_revisions(self, limit=None, offset=None, before=None):
+        '''Object revisions of this object youngest first with their
+        revisions loaded, in one query.
+
+        @param limit: at most this many (e.g. latest 20).
+        @param offset: skip this many.
+        @param before: (timestamp, revision id) of an object revision (as
+            given by revisions_cursor): only get object revisions older than
+            that one. Unlike offset this does not get slower the further back
+            we go.
+        @return: list of object revisions.
+        '''
+        revision_class = self.__revision_class__
+        sess = object_session(self)
+        q = sess.query(revision_class)
+        if has_revision_timestamp(class_mapper(revision_class).local_table):
+            # the join is only needed for the revisions of the object
+            # revisions we get (and then limit goes in a subquery)
+            timestamp = revision_class.revision_timestamp
+            q = q.options(joinedload(revision_class.revision))
+        else:
+            timestamp = Revision.timestamp
+            q = q.join(revision_class.revision).\
+                options(contains_eager(revision_class.revision))
+        revision_id = revision_class.revision_id
+        q = q.filter(revision_class.continuity_id == self.id)
+        if before is not None:
+            before_timestamp, before_revision_id = before
+            q = q.filter(or_(
+                timestamp < before_timestamp,
+                and_(timestamp == before_timestamp,
+                    revision_id < before_revision_id)
+                ))
+        q = q.order_by(timestamp.desc(), revision_id.desc())
+        if offset:
+            q = q.offset(offset)
+        if limit is not None:
+            q = q.limit(limit)
+        return q.all()
+
+    @classmethod
+    def revisions_cursor(self, obj_revision):
+        '''Keyset cursor for get_revisions(before=...) to carry on after
+        `obj_revision`.'''
+        return (obj_revision.revision.timestamp, obj_revision.revision_id)
 
     def diff(self, to_revision=None, from_revision=None):
         '''Diff this object returning changes between `from_revision` and
@@ -267,7 +650,17 @@ class RevisionedObjectMixin(object):
         '''
         obj_rev_class = self.__revision_class__
         sess = object_session(self)
-        obj_rev_query = sess.query(obj_rev_class).join('revision').\
+        if has_valid_time(class_mapper(obj_rev_class).local_table):
+            to_obj_rev, from_obj_rev = self._valid_time_revisions_to_diff(
+                    sess, to_revision, from_revision)
+            return self.diff_revisioned_fields(to_obj_rev, from_obj_rev,
+                    self)
+        if has_revision_timestamp(class_mapper(obj_rev_class).local_table):
+            obj_rev_query = sess.query(obj_rev_class).\
+                        filter(obj_rev_class.id==self.id).\
+                        order_by(obj_rev_class.revision_timestamp.desc())
+        else:
+            obj_rev_query = sess.query(obj_rev_class).join('revision').\
                         filter(obj_rev_class.id==self.id).\
                         order_by(Revision.timestamp.desc())
         obj_class = self
@@ -298,8 +691,13 @@ class RevisionedObjectMixin(object):
         sess = object_session(self)
         if to_revision is None:
             to_revision = Revision.youngest(sess)
+        if has_revision_timestamp(
+                class_mapper(self.__revision_class__).local_table):
+            timestamp = self.__revision_class__.revision_timestamp
+        else:
+            timestamp = Revision.timestamp
         out = obj_revision_query.\
-              filter(Revision.timestamp<=to_revision.timestamp)
+              filter(timestamp<=to_revision.timestamp)
         to_obj_rev = out.first()
         if not from_revision:
             from_revision = sess.query(Revision).\
@@ -308,12 +706,34 @@ class RevisionedObjectMixin(object):
         # created
         if from_revision:
             out = obj_revision_query.\
-                filter(Revision.timestamp<=from_revision.timestamp)
+                filter(timestamp<=from_revision.timestamp)
             from_obj_rev = out.first()
         else:
             from_obj_rev = None
         return to_obj_rev, from_obj_rev
     
+    def _valid_time_revisions_to_diff(self, sess, to_revision,
+            from_revision):
+        '''get_obj_revisions_to_diff for the valid time layout: no joins and
+        the previous object revision is found through its pointer.'''
+        if to_revision is None:
+            to_revision = Revision.youngest(sess)
+        to_obj_rev = self._valid_at(sess, to_revision.timestamp).first()
+        if from_revision:
+            from_obj_rev = self._valid_at(sess,
+                    from_revision.timestamp).first()
+        elif to_obj_rev is None:
+            from_obj_rev = None
+        elif to_obj_rev.revision_id != to_revision.id:
+            # not changed in to_revision
+            from_obj_rev = to_obj_rev
+        elif to_obj_rev.previous_revision_id is None:
+            from_obj_rev = None
+        else:
+            from_obj_rev = sess.query(self.__revision_class__).get(
+                    (self.id, to_obj_rev.previous_revision_id))
+        return to_obj_rev, from_obj_rev
+
     @classmethod
     def diff_revisioned_fields(self, to_obj_rev, from_obj_rev, obj_class):
         '''
@@ -352,6 +772,7 @@ class RevisionedObjectMixin(object):
 import sqlalchemy.orm.properties
 from sqlalchemy.orm import class_mapper
 from sqlalchemy.orm import relation, backref
+from sqlalchemy.orm import contains_eager, joinedload
 
 def modify_base_object_mapper(base_object, revision_obj, state_obj):
     base_mapper = class_mapper(base_object)
@@ -379,6 +800,8 @@ def create_object_version(mapper_fn, base_object, rev_table):
 
     # Must add this so base object can retrieve revisions ...
     base_object.__revision_class__ = MyClass
+    VersionedClassInfo.register(base_object,
+            class_mapper(base_object).local_table, rev_table)
 
     ourmapper = mapper_fn(MyClass, rev_table, properties={
         # NB: call it all_revisions_... rather than just revisions_... as it
@@ -466,22 +889,851 @@ def add_stateful_versioned_m2m(*args, **kwargs):
     def get_as_of(obj):
         return obj.get_as_of()
 
+    def at_HEAD(obj):
+        # query backed lists only know what is there now
+        return SQLAlchemySession.at_HEAD(object_session(obj))
+
     newkwargs = dict(kwargs)
     newkwargs['base_modifier'] = get_as_of
+    newkwargs.setdefault('use_query', at_HEAD)
     add_stateful_m2m(*args, **newkwargs)
 
 def add_stateful_versioned_m2m_on_version(revision_class, m2m_property_name):
-    # just add these m2m properties to version
+    '''Add the m2m properties (see add_stateful_versioned_m2m) to the
+    version.
+
+    At HEAD these proxy to the continuity. At a past revision they are (read
+    only) lists of what was in them at that revision (see m2m_as_of).
+    '''
     active_name = m2m_property_name + '_active'
     deleted_name = m2m_property_name + '_deleted'
     for propname in [active_name, deleted_name, m2m_property_name]:
         add_fake_relation(revision_class, propname,
                 is_many=True)
+        head = getattr(revision_class, propname)
+        setattr(revision_class, propname, property(_m2m_as_of_getter(
+            head, m2m_property_name, propname[len(m2m_property_name):])))
+
+def _m2m_as_of_getter(head, m2m_property_name, suffix):
+    def _pget(self):
+        continuity = self.continuity
+        sess = object_session(continuity)
+        if sess is None or SQLAlchemySession.at_HEAD(sess):
+            return head.fget(self)
+        revision = getattr(sess, 'revision', None)
+        continuity_class = type(continuity)
+        join_revobjs = m2m_as_of(sess, continuity_class, m2m_property_name,
+                [continuity.id], revision)[continuity.id]
+        if suffix == '_deleted':
+            return [ revobj for revobj in join_revobjs
+                    if not revobj.is_active() ]
+        active = [ revobj for revobj in join_revobjs if revobj.is_active() ]
+        if suffix == '_active':
+            return active
+        attr = continuity_class.__stateful_m2m__[m2m_property_name][1]
+        return [ getattr(revobj, attr) for revobj in active ]
+    return _pget
+
+def m2m_as_of(session, continuity_class, m2m_property_name, continuity_ids,
+        revision):
+    '''Join objects of stateful m2m `m2m_property_name` (see
+    add_stateful_versioned_m2m) as they were at `revision`, for several
+    objects at once, with one query (per 500 objects) to the join object's
+    revision table.
+
+    Unlike going through the current list of join objects this also finds
+    ones which have since been removed from it.
+
+    @return: dict of lists of join object revisions keyed by continuity id.
+    '''
+    m2m_object, attr, basic_m2m_name = \
+            continuity_class.__stateful_m2m__[m2m_property_name]
+    prop = class_mapper(continuity_class).get_property(basic_m2m_name)
+    remote = list(prop.remote_side)[0]
+    join_revision_class = m2m_object.__revision_class__
+    revision_mapper = class_mapper(join_revision_class)
+    revision_table = revision_mapper.local_table
+    fkcol = revision_table.c[remote.name]
+    fk_key = revision_mapper.get_property_by_column(fkcol).key
+    as_of_cache = AsOfCache.get(session)
+    def cache_key(continuity_id):
+        return ('m2m', continuity_class, m2m_property_name, continuity_id,
+                revision.id)
+    results = {}
+    todo = []
+    for continuity_id in continuity_ids:
+        key = cache_key(continuity_id)
+        if key in as_of_cache.results:
+            results[continuity_id] = as_of_cache.results[key]
+        else:
+            todo.append(continuity_id)
+    for ii in range(0, len(todo), IN_CLAUSE_CHUNK):
+        chunk = todo[ii:ii+IN_CLAUSE_CHUNK]
+        for continuity_id in chunk:
+            results[continuity_id] = []
+        # join objects which have ever belonged to these objects
+        ever_table = revision_table.alias()
+        ever = select([ever_table.c.continuity_id]).where(
+                ever_table.c[remote.name].in_(chunk))
+        # greatest (timestamp) per group (continuity)
+        latest = session.query(
+                revision_table.c.continuity_id.label('continuity_id'),
+                func.max(Revision.timestamp).label('timestamp')
+            ).join(Revision,
+                Revision.id == revision_table.c.revision_id
+            ).filter(
+                Revision.timestamp <= revision.timestamp
+            ).filter(
+                revision_table.c.continuity_id.in_(ever)
+            ).group_by(revision_table.c.continuity_id).subquery()
+        q = session.query(join_revision_class).join('revision').\
+            join(latest, and_(
+                join_revision_class.continuity_id == latest.c.continuity_id,
+                Revision.timestamp == latest.c.timestamp
+            )).filter(fkcol.in_(chunk)).\
+            order_by(join_revision_class.continuity_id)
+        for revobj in q:
+            results[getattr(revobj, fk_key)].append(revobj)
+            as_of_cache.results[(join_revision_class, revobj.continuity_id,
+                revision.id)] = revobj
+        for continuity_id in chunk:
+            as_of_cache.results[cache_key(continuity_id)] = \
+                    results[continuity_id]
+    return results
+
+
+def prefetch_as_of(revision_objects, names):
+    '''Load what the (fake) relations `names` of object revisions
+    `revision_objects` need for the whole batch at once.
+
+    Each fake relation goes to the continuity, then to the related object(s)
+    and then (unless the session is at HEAD) to their get_as_of, which is a
+    few queries per object revision. This gets the continuities, the related
+    objects and their versions as of the session's revision with a few
+    queries for all of them (and puts the versions in the session's
+    get_as_of cache) so that afterwards accessing the relations needs no
+    queries.
+
+    @param names: names of relations (e.g. 'license') or stateful m2m lists
+        (e.g. 'tags', see add_stateful_versioned_m2m) of the continuity
+        class.
+    '''
+    revision_objects = [ revobj for revobj in revision_objects
+            if revobj is not None ]
+    sess = None
+    for revobj in revision_objects:
+        # views of continuities (see _head_view) are not in the session but
+        # their continuities are
+        sess = object_session(revobj) or \
+                object_session(revobj.__dict__.get('continuity') or revobj)
+        if sess is not None:
+            break
+    if sess is None:
+        return
+    by_class = OrderedDict()
+    for revobj in revision_objects:
+        by_class.setdefault(type(revobj), []).append(revobj)
+    for revision_class, revobjs in by_class.items():
+        base_mapper = class_mapper(revision_class.__continuity_class__)
+        continuities = _load_related(sess,
+                class_mapper(revision_class).get_property('continuity'),
+                revobjs)
+        for name in names:
+            _prefetch_relation(sess, base_mapper, continuities, name)
+
+def _prefetch_relation(sess, mapper, objs, name):
+    m2ms = getattr(mapper.class_, '__stateful_m2m__', {})
+    for suffix in ('_active', '_deleted'):
+        if name.endswith(suffix) and name[:-len(suffix)] in m2ms:
+            name = name[:-len(suffix)]
+    if name in m2ms:
+        m2m_object, attr, basic_m2m_name = m2ms[name]
+        if SQLAlchemySession.at_HEAD(sess):
+            join_objs = _load_related(sess,
+                    mapper.get_property(basic_m2m_name), objs)
+            _prefetch_relation(sess, class_mapper(m2m_object), join_objs,
+                    attr)
+        else:
+            revision = getattr(sess, 'revision', None)
+            join_revobjs = []
+            for revobjs in m2m_as_of(sess, mapper.class_, name,
+                    [ obj.id for obj in objs ], revision).values():
+                join_revobjs.extend(revobjs)
+            revision_mapper = class_mapper(m2m_object.__revision_class__)
+            if revision_mapper.has_property(attr):
+                _load_related(sess, revision_mapper.get_property(attr),
+                        join_revobjs)
+            else:
+                # a fake relation
+                prefetch_as_of(join_revobjs, [attr])
+        return
+    prop = mapper.get_property(name)
+    if not isinstance(prop, RelationshipProperty):
+        raise ValueError('%s is not a relation of %s' % (name,
+            mapper.class_.__name__))
+    related = _load_related(sess, prop, objs)
+    if not prop.uselist and getattr(prop.mapper.class_, '__revisioned__',
+            False):
+        _prefetch_as_of_objects(sess, prop.mapper.class_, related)
+
+def _prefetch_as_of_objects(sess, cls, objs):
+    '''Put versions of objs as of the session's revision in the session's
+    get_as_of cache.
+
+    @return: the versions (None if the session is at HEAD).
+    '''
+    if SQLAlchemySession.at_HEAD(sess):
+        return None
+    revision = getattr(sess, 'revision', None)
+    as_of_cache = AsOfCache.get(sess)
+    revision_class = cls.__revision_class__
+    todo = [ obj.id for obj in objs
+            if (revision_class, obj.id, revision.id) not in as_of_cache.results ]
+    if todo:
+        results = cls.get_many_as_of(todo, revision)
+        for id_, revobj in results.items():
+            as_of_cache.results[(revision_class, id_, revision.id)] = revobj
+    return [ as_of_cache.results[(revision_class, obj.id, revision.id)]
+            for obj in objs ]
+
+def _load_by_ids(sess, mapper, ids):
+    '''Load objects of (single primary key) mapper with ids into the
+    session (those already there are not loaded again).
+
+    @return: dict of objects keyed by id.
+    '''
+    pkcol = mapper.primary_key[0]
+    objs = {}
+    todo = []
+    for id_ in set(ids):
+        if id_ is None:
+            continue
+        obj = sess.identity_map.get(
+                mapper.identity_key_from_primary_key([id_]))
+        if obj is None:
+            todo.append(id_)
+        else:
+            objs[id_] = obj
+    for ii in range(0, len(todo), IN_CLAUSE_CHUNK):
+        chunk = todo[ii:ii+IN_CLAUSE_CHUNK]
+        for obj in sess.query(mapper).filter(pkcol.in_(chunk)):
+            objs[mapper.primary_key_from_instance(obj)[0]] = obj
+    return objs
+
+def _load_related(sess, prop, objs):
+    '''Load relation `prop` (a simple foreign key one, either way) of all of
+    `objs` with one query (per chunk) and set it on them (as the session
+    only holds weak references that is what keeps them loaded).
+
+    @return: the related objects.
+    '''
+    if prop.secondary is not None or len(prop.local_columns) != 1:
+        # not supported: left to lazy loading
+        return []
+    if prop.direction is MANYTOONE:
+        fk = list(prop.local_columns)[0]
+        fk_key = prop.parent.get_property_by_column(fk).key
+        values = [ getattr(obj, fk_key) for obj in objs ]
+        loaded = _load_by_ids(sess, prop.mapper, values)
+        for obj, value in zip(objs, values):
+            if prop.key not in obj.__dict__:
+                set_committed_value(obj, prop.key, loaded.get(value))
+        return loaded.values()
+    # one to many
+    parent_mapper = prop.parent
+    remote = list(prop.remote_side)[0]
+    todo = [ obj for obj in objs if prop.key not in obj.__dict__ ]
+    related = []
+    for obj in objs:
+        if prop.key in obj.__dict__:
+            related.extend(getattr(obj, prop.key))
+    for ii in range(0, len(todo), IN_CLAUSE_CHUNK):
+        chunk = todo[ii:ii+IN_CLAUSE_CHUNK]
+        ids = [ parent_mapper.primary_key_from_instance(obj)[0]
+                for obj in chunk ]
+        q = sess.query(prop.mapper).filter(remote.in_(ids))
+        if prop.order_by:
+            q = q.order_by(*prop.order_by)
+        children = {}
+        remote_key = prop.mapper.get_property_by_column(remote).key
+        for child in q:
+            children.setdefault(getattr(child, remote_key), []).append(child)
+        for obj, id_ in zip(chunk, ids):
+            values = children.get(id_, [])
+            set_committed_value(obj, prop.key, values)
+            related.extend(values)
+    return related
 
 
 from sqlalchemy.orm import MapperExtension
-from sqlalchemy.orm import object_session
+from sqlalchemy.orm import object_session, object_mapper
+from sqlalchemy.orm import RelationshipProperty
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
 from sqlalchemy.orm import EXT_CONTINUE
+from sqlalchemy.orm import Session as _Session
+from sqlalchemy import event
+from collections import OrderedDict
+
+
+def _row_key(colvalues):
+    return (colvalues['continuity_id'], colvalues['revision_id'])
+
+
+class RevisionRowBuffer(object):
+    '''Object revision rows produced during a single session flush.
+
+    The Revisioner does not write object revisions as it goes. Instead rows are
+    collected here, grouped by revision table, and written once the flush has
+    finished (see `write`) with one `executemany` per table and statement type.
+
+    Rows are keyed on (continuity_id, revision_id) so if an object is written
+    more than once in a flush only its last state is kept.
+    '''
+    # max number of ids to put into a single IN clause
+    chunk_size = IN_CLAUSE_CHUNK
+
+    def __init__(self):
+        # revision_table: (connection, OrderedDict((continuity_id, revision_id): colvalues))
+        self.tables = OrderedDict()
+
+    def add(self, revision_table, connection, colvalues):
+        if revision_table not in self.tables:
+            self.tables[revision_table] = (connection, OrderedDict())
+        rows = self.tables[revision_table][1]
+        rows[_row_key(colvalues)] = colvalues
+
+    def __len__(self):
+        return sum([len(rows) for conn, rows in self.tables.values()])
+
+    def write(self, log):
+        for revision_table, (connection, rows) in self.tables.items():
+            self._write_table(revision_table, connection, rows, log)
+        self.tables.clear()
+
+    def _existing_keys(self, revision_table, connection, keys):
+        '''Find which of `keys` already have a row in `revision_table`.
+
+        Only used when neither the RevisionWriteLog nor a native upsert can
+        tell us whether to INSERT or UPDATE.
+        '''
+        by_revision = {}
+        for continuity_id, revision_id in keys:
+            by_revision.setdefault(revision_id, []).append(continuity_id)
+        existing = set()
+        for revision_id, continuity_ids in by_revision.items():
+            for ii in range(0, len(continuity_ids), self.chunk_size):
+                chunk = continuity_ids[ii:ii+self.chunk_size]
+                q = select([revision_table.c.continuity_id]).where(and_(
+                    revision_table.c.revision_id == revision_id,
+                    revision_table.c.continuity_id.in_(chunk)
+                    ))
+                for row in connection.execute(q):
+                    existing.add((row[0], revision_id))
+        return existing
+
+    def _write_table(self, revision_table, connection, rows, log):
+        # Allow for multiple SQLAlchemy flushes/commits per VDM revision: an
+        # object changed again in a later flush must update the object
+        # revision written by the earlier one.
+        inserts = []
+        updates = []
+        unknown = []
+        for key, colvalues in rows.items():
+            written = log.status(revision_table, key)
+            if written:
+                updates.append(colvalues)
+            elif written is None:
+                unknown.append(colvalues)
+            else:
+                inserts.append(colvalues)
+        stmts = RevisionStatements.get(revision_table)
+        connection = stmts.connection(connection)
+        if has_valid_time(revision_table) and (inserts or unknown):
+            self._replace_previous(revision_table, connection,
+                    inserts + unknown)
+        if unknown:
+            upsert = stmts.upsert(connection.dialect)
+            if upsert is not None:
+                logger.debug('Upserting %s rows in %s', len(unknown),
+                        revision_table.name)
+                connection.execute(upsert, unknown)
+            else:
+                existing = self._existing_keys(revision_table, connection,
+                        [ _row_key(colvalues) for colvalues in unknown ])
+                for colvalues in unknown:
+                    if _row_key(colvalues) in existing:
+                        updates.append(colvalues)
+                    else:
+                        inserts.append(colvalues)
+        if inserts:
+            logger.debug('Creating %s rows in %s', len(inserts),
+                    revision_table.name)
+            connection.execute(stmts.insert, inserts)
+        if updates:
+            logger.debug('Updating %s rows in %s', len(updates),
+                    revision_table.name)
+            params = []
+            for colvalues in updates:
+                colvalues = dict(colvalues)
+                colvalues['_continuity_id'], colvalues['_revision_id'] = \
+                        _row_key(colvalues)
+                # valid time is only set when an object revision is created
+                for key in VALID_TIME_COLUMNS:
+                    colvalues.pop(key, None)
+                params.append(colvalues)
+            connection.execute(stmts.update, params)
+        log.record(revision_table, rows.keys())
+        invalidate_written(revision_table, rows.keys())
+
+    def _replace_previous(self, revision_table, connection, rows):
+        '''Valid time layout: link new object revisions `rows` to the ones
+        they replace and expire those.
+
+        NB: assumes object revisions are written in revision order.
+        '''
+        by_revision = OrderedDict()
+        for colvalues in rows:
+            revision_id = colvalues['revision_id']
+            if revision_id not in by_revision:
+                valid_from = colvalues.get('valid_from')
+                if valid_from is None:
+                    # row not made by VersionedClassInfo.row
+                    revisions = revision_table.metadata.tables['revision']
+                    valid_from = connection.execute(
+                        select([revisions.c.timestamp]).where(
+                            revisions.c.id == revision_id)
+                        ).scalar()
+                by_revision[revision_id] = (valid_from, [])
+            by_revision[revision_id][1].append(colvalues)
+        c = revision_table.c
+        for revision_id, (valid_from, revrows) in by_revision.items():
+            for ii in range(0, len(revrows), self.chunk_size):
+                chunk = revrows[ii:ii+self.chunk_size]
+                current = and_(
+                    c.continuity_id.in_([ colvalues['continuity_id']
+                        for colvalues in chunk ]),
+                    c.valid_to == None,
+                    c.revision_id != revision_id
+                    )
+                q = select([c.continuity_id, c.revision_id]).where(current)
+                previous = dict([ (row[0], row[1])
+                    for row in connection.execute(q) ])
+                connection.execute(revision_table.update().where(current),
+                        valid_to=valid_from)
+                for colvalues in chunk:
+                    colvalues['valid_from'] = valid_from
+                    colvalues['valid_to'] = None
+                    colvalues['previous_revision_id'] = previous.get(
+                            colvalues['continuity_id'])
+
+    @classmethod
+    def get(self, session):
+        '''Get buffer for flush in progress on `session` (create if needed).'''
+        buf = getattr(session, '_vdm_revision_rows', None)
+        if buf is None:
+            buf = self()
+            session._vdm_revision_rows = buf
+        return buf
+
+    @classmethod
+    def discard(self, session):
+        session._vdm_revision_rows = None
+
+
+class RevisionWriteLog(object):
+    '''Object revisions a session has written for its current revision.
+
+    This lets RevisionRowBuffer choose between INSERT and UPDATE without asking
+    the database. If the revision was created in this session (see
+    SQLAlchemySession.set_revision) the log is complete: a row which is not in
+    it does not exist. Otherwise (e.g. the revision came from elsewhere) a row
+    missing from the log may still exist and has to be upserted.
+    '''
+    def __init__(self, revision_id=None, complete=False):
+        self.revision_id = revision_id
+        self.complete = complete
+        # revision_table: set of continuity ids
+        self.written = {}
+
+    def status(self, revision_table, key):
+        '''True if row `key` has been written, False if it definitely has not
+        and None if we do not know.'''
+        continuity_id, revision_id = key
+        if revision_id != self.revision_id:
+            return None
+        if continuity_id in self.written.get(revision_table, ()):
+            return True
+        if self.complete:
+            return False
+        return None
+
+    def record(self, revision_table, keys):
+        for continuity_id, revision_id in keys:
+            if revision_id != self.revision_id:
+                # only keep track of one revision at a time
+                self.revision_id = revision_id
+                self.complete = False
+                self.written = {}
+            self.written.setdefault(revision_table, set()).add(continuity_id)
+
+    def forget(self):
+        '''Forget what was written (so from now on we do not know).'''
+        self.complete = False
+        self.written = {}
+
+    @classmethod
+    def get(self, session):
+        log = getattr(session, '_vdm_write_log', None)
+        if log is None:
+            log = self()
+            session._vdm_write_log = log
+        return log
+
+    @classmethod
+    def start(self, session, revision_id):
+        '''Start a complete log for brand new revision `revision_id`.'''
+        session._vdm_write_log = self(revision_id, complete=True)
+
+    @classmethod
+    def discard(self, session):
+        session._vdm_write_log = None
+
+
+def _is_settled(session, revision):
+    '''Can what was in `revision` be shared with other sessions (see
+    cache)? Only if it is in the database and session is not writing to
+    it.'''
+    state = instance_state(revision)
+    if state.key is None or state.modified:
+        return False
+    log = getattr(session, '_vdm_write_log', None)
+    return log is None or log.revision_id != revision.id
+
+def _put_row(shared, mapper, obj):
+    '''Put column values of (loaded, persistent) `obj` in the shared cache.
+
+    @return: cache key.
+    '''
+    table = mapper.local_table
+    colvalues = dict([ (col.key, getattr(obj, col.key)) for col in table.c ])
+    if 'continuity_id' in colvalues:
+        key = ('row', table.name, colvalues['continuity_id'],
+                colvalues['revision_id'])
+        tags = [('revision', colvalues['revision_id']),
+                ('continuity', table.name, colvalues['continuity_id'])]
+    else:
+        key = ('row', table.name, colvalues['id'])
+        tags = [('revision', colvalues['id'])]
+    shared.put(key, colvalues, tags)
+    return key
+
+def _cached_object(session, mapper, colvalues):
+    '''Object for cached `colvalues` in `session` (as if it was loaded).'''
+    key = mapper.identity_key_from_primary_key([ colvalues[col.key]
+        for col in mapper.primary_key ])
+    obj = session.identity_map.get(key)
+    if obj is None:
+        obj = mapper.class_manager.new_instance()
+        for name, value in colvalues.items():
+            set_committed_value(obj, name, value)
+        make_transient_to_detached(obj)
+        session.add(obj)
+    return obj
+
+def invalidate_written(revision_table, keys):
+    '''Drop what the process-wide cache knows about object revisions with
+    `keys` ((continuity id, revision id) pairs) just written to
+    `revision_table`.'''
+    shared = cache.get_cache()
+    if shared is None:
+        return
+    for revision_id in set([ key[1] for key in keys ]):
+        shared.invalidate(('revision', revision_id))
+    # what the objects were as of other revisions may have changed too (e.g.
+    # the revision is older than ones already written)
+    for continuity_id in set([ key[0] for key in keys ]):
+        shared.invalidate(('continuity', revision_table.name, continuity_id))
+
+class AsOfCache(object):
+    '''get_as_of results of a session keyed by (revision class, continuity
+    id, revision id).
+
+    Discarded when the session's revision changes, after each flush (which
+    may change what objects looked like at the revision) and on rollback.
+    '''
+    def __init__(self):
+        self.results = {}
+
+    @classmethod
+    def get(self, session):
+        cache = getattr(session, '_vdm_as_of_cache', None)
+        if cache is None:
+            cache = self()
+            session._vdm_as_of_cache = cache
+        return cache
+
+    @classmethod
+    def discard(self, session):
+        session._vdm_as_of_cache = None
+
+
+def _upsert_columns(revision_table):
+    '''Columns an upsert updates if the row exists (the valid time of an
+    object revision is only set when it is created).'''
+    return [ col for col in revision_table.c if not col.primary_key and
+            col.name not in VALID_TIME_COLUMNS ]
+
+def make_upsert(revision_table, dialect):
+    '''Return an INSERT ... ON CONFLICT DO UPDATE statement for
+    `revision_table` or None if `dialect` has no native upsert.
+
+    Supported for PostgreSQL >= 9.5 and SQLite >= 3.24.
+    '''
+    pkcols = list(revision_table.primary_key.columns)
+    if dialect.name == 'postgresql':
+        if (dialect.server_version_info or (0,)) < (9, 5):
+            return None
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        ins = pg_insert(revision_table)
+        updates = dict([ (col.name, ins.excluded[col.name])
+            for col in _upsert_columns(revision_table) ])
+        return ins.on_conflict_do_update(index_elements=pkcols, set_=updates)
+    elif dialect.name == 'sqlite':
+        if dialect.dbapi.sqlite_version_info < (3, 24):
+            return None
+        return _SQLiteUpsert(revision_table)
+    return None
+
+
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy.ext.compiler import compiles
+
+class _SQLiteUpsert(Insert):
+    '''INSERT ... ON CONFLICT (primary key) DO UPDATE for SQLite (which
+    SQLAlchemy does not support natively).'''
+    pass
+
+@compiles(_SQLiteUpsert, 'sqlite')
+def _compile_sqlite_upsert(insert, compiler, **kw):
+    out = compiler.visit_insert(insert, **kw)
+    quote = compiler.preparer.quote
+    table = insert.table
+    pknames = [ quote(col.name) for col in table.primary_key.columns ]
+    updates = [ '%s = excluded.%s' % (quote(col.name), quote(col.name))
+            for col in _upsert_columns(table) ]
+    return '%s ON CONFLICT (%s) DO UPDATE SET %s' % (out, ', '.join(pknames),
+            ', '.join(updates))
+
+
+def _before_flush_discard_revision_rows(session, flush_context, instances):
+    # anything left over is from a flush that failed
+    RevisionRowBuffer.discard(session)
+    session._vdm_is_changed = None
+
+def _after_flush_write_revision_rows(session, flush_context):
+    buf = getattr(session, '_vdm_revision_rows', None)
+    if buf:
+        buf.write(RevisionWriteLog.get(session))
+    RevisionRowBuffer.discard(session)
+    session._vdm_is_changed = None
+    AsOfCache.discard(session)
+
+def _has_versioned_change(session):
+    '''Will flushing session (may) produce object revisions?
+
+    Errs on the side of yes: any change to a relation of a versioned object
+    (or to a versioned object) counts as foreign keys of versioned objects
+    will only be synchronised during the flush.
+    '''
+    for obj in session.new:
+        if getattr(obj, '__revisioned__', False):
+            return True
+    for obj in session.dirty:
+        revisioned = getattr(obj, '__revisioned__', False)
+        if revisioned and has_real_change(obj):
+            return True
+        state = instance_state(obj)
+        for prop in state.mapper.relationships:
+            if not (revisioned or
+                    getattr(prop.mapper.class_, '__revisioned__', False)):
+                continue
+            if prop.key not in state.committed_state:
+                continue
+            history = get_history(obj, prop.key,
+                    passive=PASSIVE_NO_INITIALIZE)
+            if history.added or history.deleted:
+                return True
+    return False
+
+def _before_flush_add_revision(session, flush_context, instances):
+    # the session's revision is only written once it is actually needed
+    if getattr(session, 'revisioning_disabled', False):
+        return
+    revision = SQLAlchemySession.get_revision(session)
+    if revision is None:
+        return
+    if instance_state(revision).key is not None or revision in session:
+        return
+    if _has_versioned_change(session):
+        logger.debug('Adding %s to session', revision)
+        session.add(revision)
+
+def _after_rollback_discard_write_log(session):
+    # rows we wrote may be gone so we know nothing any more
+    RevisionWriteLog.discard(session)
+    AsOfCache.discard(session)
+
+event.listen(_Session, 'before_flush', _before_flush_discard_revision_rows)
+event.listen(_Session, 'before_flush', _before_flush_add_revision)
+event.listen(_Session, 'after_flush', _after_flush_write_revision_rows)
+event.listen(_Session, 'after_rollback', _after_rollback_discard_write_log)
+
+
+class RevisionStatements(object):
+    '''Statements used to write object revisions to `revision_table`.
+
+    They are built once per revision table and compiled at most once per
+    dialect (executing them with `compiled_cache`).
+    '''
+    # revision_table: RevisionStatements
+    _registry = {}
+
+    def __init__(self, revision_table):
+        self.revision_table = revision_table
+        self.insert = revision_table.insert()
+        self.update = revision_table.update().where(and_(
+            revision_table.c.continuity_id == bindparam('_continuity_id'),
+            revision_table.c.revision_id == bindparam('_revision_id')
+            ))
+        self._upserts = {}
+        self.compiled_cache = {}
+
+    def upsert(self, dialect):
+        '''Upsert statement for dialect (None if not supported).'''
+        key = (dialect.name, dialect.server_version_info)
+        if key not in self._upserts:
+            self._upserts[key] = make_upsert(self.revision_table, dialect)
+        return self._upserts[key]
+
+    def connection(self, connection):
+        return connection.execution_options(
+                compiled_cache=self.compiled_cache)
+
+    @classmethod
+    def get(self, revision_table):
+        stmts = self._registry.get(revision_table)
+        if stmts is None:
+            stmts = self(revision_table)
+            self._registry[revision_table] = stmts
+        return stmts
+
+
+class VersionedClassInfo(object):
+    '''Versioning metadata for a versioned domain object class.
+
+    Registered by create_object_version so that the per object work done when
+    writing object revisions does not need to look at mappers and tables.
+    '''
+    # versioned class: VersionedClassInfo
+    _registry = {}
+
+    def __init__(self, class_, table, revision_table):
+        self.class_ = class_
+        self.table = table
+        self.revision_table = revision_table
+        self.columns = table.c.keys()
+        self.fields = [ col.name for col in table.c
+                if col.name not in class_.__ignored_fields__ ]
+        pkcols = [ col.key for col in table.primary_key.columns ]
+        assert len(pkcols) == 1, pkcols
+        self.primary_key = pkcols[0]
+        self.statements = RevisionStatements.get(revision_table)
+        self.valid_time = has_valid_time(revision_table)
+        self.revision_timestamp = has_revision_timestamp(revision_table)
+        self._getter = operator.attrgetter(*self.columns)
+        if len(self.columns) == 1:
+            getter = self._getter
+            self._getter = lambda instance: (getter(instance),)
+
+    def row(self, instance):
+        '''Column values for a new object revision of `instance`.'''
+        colvalues = dict(zip(self.columns, self._getter(instance)))
+        revision_id = instance.revision.id
+        assert revision_id
+        colvalues['revision_id'] = revision_id
+        colvalues['continuity_id'] = colvalues[self.primary_key]
+        if self.valid_time:
+            colvalues['valid_from'] = instance.revision.timestamp
+        if self.revision_timestamp:
+            colvalues['revision_timestamp'] = instance.revision.timestamp
+        return colvalues
+
+    @classmethod
+    def register(self, class_, table, revision_table):
+        info = self(class_, table, revision_table)
+        self._registry[class_] = info
+        return info
+
+    @classmethod
+    def get(self, class_):
+        '''Info for versioned class `class_` (None if not registered).'''
+        return self._registry.get(class_)
+
+# mapper: [ (key, attribute impl) ] for the revisioned fields of mapper
+_revisioned_impls = {}
+
+def revisioned_impls(state):
+    mapper = state.mapper
+    impls = _revisioned_impls.get(mapper)
+    if impls is None:
+        impls = [ (key, state.manager[key].impl)
+                for key in state.class_.revisioned_fields() ]
+        _revisioned_impls[mapper] = impls
+    return impls
+
+def has_real_change(instance):
+    '''Return True if any revisioned field of `instance` has really changed.
+
+    Only looks at what is already in memory so never loads anything from the
+    database: a field which is not loaded cannot have been changed. A field
+    which was set without having been loaded counts as changed (we would have
+    to load it to know any better).
+    '''
+    state = instance_state(instance)
+    committed = state.committed_state
+    if not committed:
+        return False
+    dict_ = state.dict
+    for key, impl in revisioned_impls(state):
+        if key not in committed:
+            continue
+        original = committed[key]
+        if original is NO_VALUE:
+            return True
+        current = dict_.get(key, NO_VALUE)
+        if current is NO_VALUE or not impl.is_equal(current, original):
+            return True
+    return False
+
+def revision_row(instance, table):
+    '''Column values for a new object revision of `instance`.
+
+    @param table: the (continuity) table instance is mapped to.
+    '''
+    info = VersionedClassInfo.get(type(instance))
+    if info is not None and info.table is table:
+        return info.row(instance)
+    colvalues = {}
+    for key in table.c.keys():
+        val = getattr(instance, key)
+        colvalues[key] = val
+    # because it is unlikely instance has been refreshed at this point the
+    # fk revision_id is not yet set on this object so get it directly
+    assert instance.revision.id
+    colvalues['revision_id'] = instance.revision.id
+    colvalues['continuity_id'] = instance.id
+    return colvalues
+
 
 class Revisioner(MapperExtension):
     '''SQLAlchemy MapperExtension which implements revisioning of sqlalchemy
@@ -495,16 +1747,28 @@ class Revisioner(MapperExtension):
           changed when not (just a related attribute has changed).
         * support for ignored attributes (these attributes will be ignored when
           checking for changes and creating new revisions of the object)
+        * object revisions are not written one at a time but buffered and
+          written in bulk at the end of the flush (see RevisionRowBuffer)
     '''
 
     def __init__(self, revision_table):
         self.revision_table = revision_table
-        # Sometimes (not predictably) the after_update method is called
-        # *after* the next instance's before_update! So to avoid this,
-        # we store the instance with the is_changed flag.
-        # It is a weak key dictionary to make sure the instance is garbage
-        # collected.
-        self._is_changed = weakref.WeakKeyDictionary() # instance:is_changed
+
+    def _is_changed(self, instance):
+        '''is_changed flags (instance: is_changed) for the flush in progress.
+
+        Sometimes (not predictably) the after_update method is called *after*
+        the next instance's before_update! So to avoid this, we store the
+        instance with the is_changed flag. One Revisioner is shared by all
+        sessions (and threads) so the flags are kept on the flushing session
+        and thrown away at the end of each flush.
+        '''
+        sess = object_session(instance)
+        is_changed = getattr(sess, '_vdm_is_changed', None)
+        if is_changed is None:
+            is_changed = {}
+            sess._vdm_is_changed = is_changed
+        return is_changed
 
     def revisioning_disabled(self, instance):
         # logger.debug('revisioning_disabled: %s' % instance)
@@ -543,6 +1807,9 @@ class Revisioner(MapperExtension):
         # properly!
         logger.debug('Revisioner.set_revision: revision is %s', current_rev)
         assert current_rev.id, 'Must have a revision.id to create object revision'
+        assert (instance_state(current_rev).key is not None or
+                current_rev in sess), \
+                'Revision was not added to the Session before the flush'
         instance.revision = current_rev
         # must set both since we are already in flush so setting object will
         # not be enough
@@ -550,53 +1817,23 @@ class Revisioner(MapperExtension):
 
     def check_real_change(self, instance, mapper, connection):
         # check each attribute to see if they have been changed
-        logger.debug('check_real_change: %s', instance)
-        if sqav.startswith("0.4"):
-            state = instance._state
-        else:
-            state = instance
-        for key in instance.revisioned_fields():
-            (added, unchanged, deleted) = get_history(state,
-                                                      key,
-                                                      passive = PASSIVE_OFF)
-            if added or deleted:
-                logger.debug('check_real_change: True')
-                return True
-        logger.debug('check_real_change: False')
-        return False
+        changed = has_real_change(instance)
+        # NB: not str(instance) as that would load any unloaded attributes
+        logger.debug('check_real_change: %s %s', instance_str(instance),
+                changed)
+        return changed
 
     def make_revision(self, instance, mapper, connection):
         # NO GOOD working with the object as that only gets committed at next
         # flush. Need to work with the table directly
-        colvalues = {}
-        table = mapper.tables[0]
-        for key in table.c.keys():
-            val = getattr(instance, key)
-            colvalues[key] = val
-        # because it is unlikely instance has been refreshed at this point the
-        # fk revision_id is not yet set on this object so get it directly
-        assert instance.revision.id
-        colvalues['revision_id'] = instance.revision.id
-        colvalues['continuity_id'] = instance.id
-
-        # Allow for multiple SQLAlchemy flushes/commits per VDM revision
-        revision_already_query = self.revision_table.count()
-        existing_revision_clause = and_(
-                self.revision_table.c.continuity_id == instance.id,
-                self.revision_table.c.revision_id == instance.revision.id)
-        revision_already_query = revision_already_query.where(
-                existing_revision_clause
-                )
-        num_revisions = connection.execute(revision_already_query).scalar()
-        revision_already = num_revisions > 0
+        colvalues = revision_row(instance, mapper.tables[0])
 
-        if revision_already:
-            logger.debug('Updating version of %s: %s', instance, colvalues)
-            connection.execute(self.revision_table.update(existing_revision_clause).values(colvalues))
-        else:
-            logger.debug('Creating version of %s: %s', instance, colvalues)
-            ins = self.revision_table.insert().values(colvalues)
-            connection.execute(ins)
+        # Rows are written in bulk at the end of the flush (in
+        # RevisionRowBuffer.write) which also takes care of multiple
+        # SQLAlchemy flushes/commits per VDM revision
+        logger.debug('Buffering version of %s: %s', instance, colvalues)
+        buf = RevisionRowBuffer.get(object_session(instance))
+        buf.add(self.revision_table, connection, colvalues)
 
         # set to None to avoid accidental reuse
         # ERROR: cannot do this as after_* is called per object and may be run
@@ -605,11 +1842,12 @@ class Revisioner(MapperExtension):
         # object_session(instance).revision = None
 
     def before_update(self, mapper, connection, instance):
-        self._is_changed[instance] = self.check_real_change(instance, mapper, connection)
-        if not self.revisioning_disabled(instance) and self._is_changed[instance]:
+        is_changed = self._is_changed(instance)
+        is_changed[instance] = self.check_real_change(instance, mapper, connection)
+        if not self.revisioning_disabled(instance) and is_changed[instance]:
             logger.debug('before_update: %s', instance)
             self.set_revision(instance)
-            self._is_changed[instance] = self.check_real_change(
+            is_changed[instance] = self.check_real_change(
                 instance, mapper, connection)
         return EXT_CONTINUE
 
@@ -617,20 +1855,23 @@ class Revisioner(MapperExtension):
     # instance has been properly created (which means e.g. instance.id is
     # available ...)
     def before_insert(self, mapper, connection, instance):
-        self._is_changed[instance] = self.check_real_change(instance, mapper, connection)
-        if not self.revisioning_disabled(instance) and self._is_changed[instance]:
+        is_changed = self._is_changed(instance)
+        is_changed[instance] = self.check_real_change(instance, mapper, connection)
+        if not self.revisioning_disabled(instance) and is_changed[instance]:
             logger.debug('before_insert: %s', instance)
             self.set_revision(instance)
         return EXT_CONTINUE
 
     def after_update(self, mapper, connection, instance):
-        if not self.revisioning_disabled(instance) and self._is_changed[instance]:
+        if not self.revisioning_disabled(instance) and \
+                self._is_changed(instance)[instance]:
             logger.debug('after_update: %s', instance)
             self.make_revision(instance, mapper, connection)
         return EXT_CONTINUE
 
     def after_insert(self, mapper, connection, instance):
-        if not self.revisioning_disabled(instance) and self._is_changed[instance]:
+        if not self.revisioning_disabled(instance) and \
+                self._is_changed(instance)[instance]:
             logger.debug('after_insert: %s', instance)
             self.make_revision(instance, mapper, connection)
         return EXT_CONTINUE
@@ -640,3 +1881,163 @@ class Revisioner(MapperExtension):
         # TODO: 2009-02-13 why is this needed? Can we remove this?
         return EXT_CONTINUE
 
+    def instrument_class(self, mapper, class_):
+        # so SessionRevisioner knows to leave this class alone
+        class_.__revisioner__ = self
+        return EXT_CONTINUE
+
+
+class SessionRevisioner(object):
+    '''Revisioning of versioned objects driven by session flush events.
+
+    This is an alternative to putting a Revisioner extension on each mapper.
+    Rather than being called several times per instance during the flush it
+    looks at the session once before the flush (to decide what really changed
+    and stamp the revision onto it) and once after (to write all object
+    revisions in one go). To use it map your classes *without* the Revisioner
+    extension and then::
+
+        SessionRevisioner().listen(Session)
+
+    where Session is a Session, sessionmaker or scoped_session. Classes which
+    do have a Revisioner extension are skipped.
+    '''
+
+    def __init__(self):
+        # Session classes or instances we are revisioning for
+        self._targets = []
+        # mapper: relations whose changes are real changes (see
+        # _revisioned_relations)
+        self._relations = {}
+
+    def listen(self, session):
+        if isinstance(session, sqlalchemy.orm.scoping.ScopedSession):
+            session = session.session_factory
+        if isinstance(session, sqlalchemy.orm.sessionmaker):
+            session = session.class_
+        if not self._targets:
+            # listen on Session itself rather than on session: in SQLAlchemy
+            # 1.1 listening on a Session subclass (as made by sessionmaker)
+            # hides the listeners on Session, including vdm's own
+            event.listen(_Session, 'before_flush', self.before_flush)
+            event.listen(_Session, 'after_flush', self.after_flush)
+        self._targets.append(session)
+
+    def is_listening(self, session):
+        for target in self._targets:
+            if session is target:
+                return True
+            if isinstance(target, type) and isinstance(session, target):
+                return True
+        return False
+
+    def is_versioned(self, instance):
+        cls = type(instance)
+        return (getattr(cls, '__revisioned__', False) and
+                hasattr(cls, '__revision_class__') and
+                getattr(cls, '__revisioner__', None) is None)
+
+    def _revisioned_relations(self, mapper, fields):
+        '''Many-to-one relations which set one of `fields`.
+
+        Before the flush foreign keys have not yet been synchronised with
+        relations (e.g. package.license_id with package.license) so we have to
+        look at the relations themselves.
+        '''
+        if mapper not in self._relations:
+            relations = []
+            for prop in mapper.iterate_properties:
+                if not isinstance(prop, RelationshipProperty):
+                    continue
+                if prop.direction is not MANYTOONE:
+                    continue
+                if [ col for col in prop.local_columns if col.key in fields ]:
+                    relations.append(prop.key)
+            self._relations[mapper] = relations
+        return self._relations[mapper]
+
+    def check_real_change(self, instance):
+        if has_real_change(instance):
+            return True
+        mapper = object_mapper(instance)
+        relations = self._revisioned_relations(mapper,
+                instance.revisioned_fields())
+        for key in relations:
+            (added, unchanged, deleted) = get_history(instance, key,
+                    passive=PASSIVE_NO_INITIALIZE)
+            if added or deleted:
+                return True
+        return False
+
+    def _collection_members(self, session):
+        '''Versioned objects added to or removed from a one-to-many relation
+        of another object.
+
+        The flush sets their foreign key (e.g. page.site_id for site.pages)
+        but, unless the relation has a backref, nothing marks the objects
+        themselves as changed.
+        '''
+        members = []
+        for obj in list(session.new) + list(session.dirty):
+            state = instance_state(obj)
+            for prop in state.mapper.relationships:
+                if prop.direction is not ONETOMANY:
+                    continue
+                history = get_history(obj, prop.key,
+                        passive=PASSIVE_NO_INITIALIZE)
+                added = history.added or ()
+                deleted = history.deleted or ()
+                # removed delete-orphans are deleted rather than changed
+                if prop.cascade.delete_orphan:
+                    deleted = ()
+                for member in list(added) + list(deleted):
+                    if member in session.deleted or \
+                            not self.is_versioned(member):
+                        continue
+                    fields = member.revisioned_fields()
+                    if [ col for col in prop.remote_side
+                            if col.key in fields ]:
+                        members.append(member)
+        return members
+
+    def before_flush(self, session, flush_context, instances):
+        if not self.is_listening(session):
+            return
+        if getattr(session, 'revisioning_disabled', False):
+            return
+        changed = [ obj for obj in session.new if self.is_versioned(obj) ]
+        changed += [ obj for obj in session.dirty if self.is_versioned(obj)
+                and self.check_real_change(obj) ]
+        seen = set([ id(obj) for obj in changed ])
+        for obj in self._collection_members(session):
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                changed.append(obj)
+        session._vdm_changed = changed
+        if not changed:
+            return
+        revision = SQLAlchemySession.get_revision(session)
+        assert revision, 'No revision is currently set for this Session'
+        assert revision.id, 'Must have a revision.id to create object revision'
+        # before the flush we can set relations as well as columns
+        for obj in changed:
+            logger.debug('SessionRevisioner: %s changed', obj)
+            obj.revision = revision
+            obj.revision_id = revision.id
+
+    def after_flush(self, session, flush_context):
+        if not self.is_listening(session):
+            return
+        changed = getattr(session, '_vdm_changed', None)
+        session._vdm_changed = None
+        if not changed:
+            return
+        buf = RevisionRowBuffer()
+        for obj in changed:
+            mapper = object_mapper(obj)
+            revision_table = class_mapper(obj.__revision_class__).local_table
+            connection = session.connection(mapper=mapper)
+            buf.add(revision_table, connection,
+                    revision_row(obj, mapper.local_table))
+        buf.write(RevisionWriteLog.get(session))
+
@@ -0,0 +1,273 @@
+'''Rough benchmarks for vdm using the demo domain model (see demo.py).
+
+They need the same database as the tests. Run them with::
+
+    python -m vdm.sqlalchemy.benchmark
+'''
+import re
+import time
+
+from sqlalchemy import event
+
+
+class StatementCounter(object):
+    '''Record statements executed on `engine` (while started).'''
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context,
+            executemany):
+        self.statements.append((statement, executemany))
+
+    def start(self):
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+
+    def stop(self):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def count(self, prefix=''):
+        return len([ s for s, many in self.statements if s.startswith(prefix) ])
+
+    def on_table(self, table_name):
+        '''Statements which refer to table `table_name`.'''
+        pattern = re.compile(r'\b%s\b' % table_name)
+        return [ s for s, many in self.statements if pattern.search(s) ]
+
+
+def _report(name, counter, num_objects, seconds):
+    revision_statements = len(counter.on_table('package_revision'))
+    print '%-40s %6s objects %4s statements (%s on revision tables) %.3fs' % (
+            name, num_objects, counter.count(), revision_statements, seconds)
+
+
+def bench_revision_writes(num_objects=1000):
+    '''Statements needed to write object revisions.
+
+    Before object revisions were buffered every object revision cost 2
+    statements (a count and then an insert or update).
+    '''
+    from demo import repo, engine, Session, Package, Revision
+    from base import SQLAlchemySession
+    repo.rebuild_db()
+    counter = StatementCounter(engine)
+
+    counter.start()
+    start = time.time()
+    rev = repo.new_revision()
+    for ii in range(num_objects):
+        Session.add(Package(name=u'bench%s' % ii, title=u'a'))
+    repo.commit_and_remove()
+    counter.stop()
+    _report('create', counter, num_objects, time.time() - start)
+    rev_id = rev.id
+
+    pkgs = Session.query(Package).all()
+    counter.start()
+    start = time.time()
+    repo.new_revision()
+    for pkg in pkgs:
+        pkg.title = u'b'
+    Session.flush()
+    for pkg in pkgs:
+        pkg.title = u'c'
+    repo.commit_and_remove()
+    counter.stop()
+    _report('update (2 flushes)', counter, num_objects, time.time() - start)
+
+    # a revision this session did not create: needs the database to tell
+    # whether object revisions exist
+    pkgs = Session.query(Package).all()
+    rev = Session.query(Revision).get(rev_id)
+    counter.start()
+    start = time.time()
+    SQLAlchemySession.set_revision(Session, rev)
+    for pkg in pkgs:
+        pkg.title = u'd'
+    repo.commit_and_remove()
+    counter.stop()
+    _report('update (existing revision)', counter, num_objects,
+            time.time() - start)
+
+
+def bench_revision_rows(num_objects=1000, repeat=20):
+    '''Python time spent building object revision rows (no database).'''
+    from demo import repo, Session, Package
+    from base import revision_row
+    from sqlalchemy.orm import class_mapper
+    repo.rebuild_db()
+    repo.new_revision()
+    pkgs = [ Package(name=u'bench%s' % ii, title=u'a')
+            for ii in range(num_objects) ]
+    Session.add_all(pkgs)
+    Session.flush()
+    table = class_mapper(Package).local_table
+    start = time.time()
+    for ii in range(repeat):
+        for pkg in pkgs:
+            revision_row(pkg, table)
+    seconds = time.time() - start
+    print '%-40s %6s objects %.1fus per object' % ('revision rows',
+            num_objects, seconds / (num_objects * repeat) * 1e6)
+    repo.commit_and_remove()
+
+
+def bench_bulk_load(num_objects=20000):
+    '''Repository.bulk_load with and without COPY.'''
+    from demo import repo, Package
+    for use_copy in (False, True):
+        repo.rebuild_db()
+        repo.new_revision()
+        rows = ( {'name': u'bench%s' % ii, 'title': u'a'}
+                for ii in range(num_objects) )
+        stats = repo.bulk_load(Package, rows, use_copy=use_copy)
+        repo.commit_and_remove()
+        name = 'bulk_load (%s)' % (use_copy and 'copy' or 'executemany')
+        print '%-40s %6s objects %.0f objects/s %.3fs' % (name,
+                stats['objects'], stats['rate'], stats['seconds'])
+
+
+def sqlite_file_engine(path):
+    '''Engine for SQLite database file `path` which many threads can write
+    to at once.'''
+    from sqlalchemy import create_engine
+    engine = create_engine('sqlite:///%s' % path,
+            connect_args={'timeout': 60, 'check_same_thread': False})
+    # take the write lock at the start of each transaction (rather than
+    # failing when upgrading a read lock) so writers queue up
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+    @event.listens_for(engine, 'begin')
+    def do_begin(conn):
+        conn.execute('BEGIN IMMEDIATE')
+    return engine
+
+
+def _writer(make_session, name, num_revisions, packages_per_revision,
+        errors):
+    from demo import Package, Revision
+    from base import SQLAlchemySession
+    try:
+        session = make_session()
+        for ii in range(num_revisions):
+            rev = Revision(author=name)
+            SQLAlchemySession.set_revision(session, rev)
+            for jj in range(packages_per_revision):
+                pkgname = u'%s-%s' % (name, jj)
+                pkg = session.query(Package).filter_by(name=pkgname).first()
+                if pkg is None:
+                    pkg = Package(name=pkgname)
+                    session.add(pkg)
+                pkg.title = u'%s' % ii
+            session.commit()
+        session.close()
+    except Exception, inst:
+        errors.append(inst)
+        raise
+
+
+def run_writers(make_session, num_threads, num_revisions=10,
+        packages_per_revision=5):
+    '''Run `num_threads` threads at once, each with its own session
+    (from `make_session`) writing `num_revisions` revisions which each
+    change `packages_per_revision` packages named after the thread.
+
+    @return: (exceptions raised in the threads, seconds taken).
+    '''
+    import threading
+    errors = []
+    threads = [ threading.Thread(target=_writer,
+        args=(make_session, u'writer%s' % ii, num_revisions,
+            packages_per_revision, errors))
+        for ii in range(num_threads) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors, time.time() - start
+
+
+def bench_concurrent_writers(thread_counts=(1, 8), num_revisions=10):
+    '''Revisions written per second by many threads at once, each with its
+    own session (on a SQLite database file of its own).'''
+    import os
+    import shutil
+    import tempfile
+    from sqlalchemy.orm import sessionmaker
+    from demo import metadata
+    tmpdir = tempfile.mkdtemp()
+    try:
+        engine = sqlite_file_engine(os.path.join(tmpdir, 'vdm.db'))
+        make_session = sessionmaker(bind=engine, autoflush=True,
+                autocommit=False)
+        for num_threads in thread_counts:
+            metadata.drop_all(bind=engine)
+            metadata.create_all(bind=engine)
+            errors, seconds = run_writers(make_session, num_threads,
+                    num_revisions)
+            assert not errors, errors
+            name = 'concurrent writers (%s threads)' % num_threads
+            print '%-40s %6s revisions %.0f revisions/s' % (name,
+                    num_threads * num_revisions,
+                    num_threads * num_revisions / seconds)
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_stateful_list(num_items=10000, repeat=3):
+    '''len and indexed access on a StatefulList most of whose items are
+    deleted (no database).'''
+    from stateful import StatefulList
+    class Item(object):
+        def __init__(self, active):
+            self.active = active
+    items = [ Item(ii % 10 == 0) for ii in range(num_items) ]
+    start = time.time()
+    # nothing changes behind its back so what is active can be kept
+    slist = StatefulList(items, is_active=lambda x: x.active,
+            identifier=lambda x: x.active, watch=lambda slist: lambda: True)
+    len(slist)
+    print '%-40s %6s items %.3fs' % ('stateful list first len', num_items,
+            time.time() - start)
+    start = time.time()
+    for ii in range(repeat):
+        for jj in range(len(slist)):
+            slist[jj]
+    seconds = time.time() - start
+    print '%-40s %6s items %.1fus per access' % ('stateful list',
+            num_items, seconds / (len(slist) * repeat) * 1e6)
+
+
+def bench_stateful_list_replace(num_items=1000):
+    '''Replacing all the items of a StatefulList (e.g. pkg.tags = [...])
+    with a list half of which is already there (no database).'''
+    from stateful import StatefulList
+    class Item(object):
+        def __init__(self, name):
+            self.name = name
+            self.active = True
+    items = [ Item(ii) for ii in range(num_items) ]
+    slist = StatefulList(items, is_active=lambda x: x.active,
+            delete=lambda x: setattr(x, 'active', False),
+            undelete=lambda x: setattr(x, 'active', True),
+            identifier=lambda x: x.name)
+    new_items = [ Item(ii) for ii in range(num_items / 2, num_items * 3 / 2) ]
+    start = time.time()
+    slist[:] = new_items
+    seconds = time.time() - start
+    assert len(slist) == num_items
+    print '%-40s %6s items %.3fs' % ('stateful list replace', num_items,
+            seconds)
+
+
+if __name__ == '__main__':
+    bench_revision_writes()
+    bench_revision_rows()
+    bench_bulk_load()
+    bench_concurrent_writers()
+    bench_stateful_list()
+    bench_stateful_list_replace()
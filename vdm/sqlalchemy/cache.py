@@ -0,0 +1,109 @@
+'''Process-wide cache of historical rows (object revisions and revisions).
+
+Once their revision is committed object revision rows do not change (short
+of Repository.purge_revision) so they can be shared between sessions and
+threads. The cache is off by default. Turn it on with::
+
+    from vdm.sqlalchemy import cache
+    cache.configure(maxsize=10000, ttl=300)
+
+What is cached are plain dicts of column values (never mapped objects, which
+belong to one session) plus which object revision get_as_of found for a
+given object and revision. Entries are tagged (e.g. with their revision id)
+so everything about one revision or one object can be invalidated at once.
+'''
+import threading
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+class LRUCache(object):
+    '''Thread safe least recently used cache with an optional time to live.
+
+    @param maxsize: maximum number of entries.
+    @param ttl: seconds an entry stays valid (None for ever).
+    '''
+    def __init__(self, maxsize=10000, ttl=None, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key: (expires, value, tags)
+        self._entries = OrderedDict()
+        # tag: set of keys
+        self._tags = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, _missing)
+            if entry is not _missing and entry[0] is not None and \
+                    entry[0] <= self.timer():
+                self._untag(key, entry[2])
+                entry = _missing
+            if entry is _missing:
+                self.misses += 1
+                return default
+            # most recently used go last
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, tags=()):
+        expires = None
+        if self.ttl is not None:
+            expires = self.timer() + self.ttl
+        with self._lock:
+            old = self._entries.pop(key, _missing)
+            if old is not _missing:
+                self._untag(key, old[2])
+            self._entries[key] = (expires, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                oldkey, oldentry = self._entries.popitem(last=False)
+                self._untag(oldkey, oldentry[2])
+
+    def invalidate(self, tag):
+        '''Drop all entries tagged with `tag`.'''
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                entry = self._entries.pop(key, _missing)
+                if entry is not _missing:
+                    self._untag(key, entry[2])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _untag(self, key, tags):
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+_cache = None
+
+def configure(maxsize=10000, ttl=None):
+    '''Turn on the cache (replacing any existing one).'''
+    global _cache
+    _cache = LRUCache(maxsize, ttl)
+    return _cache
+
+def disable():
+    global _cache
+    _cache = None
+
+def get_cache():
+    '''The cache (None if it is not turned on).'''
+    return _cache
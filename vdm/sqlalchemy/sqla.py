@@ -2,6 +2,9 @@
 '''
 import sqlalchemy
 
+# class: names of the mapped table's columns (see SQLAlchemyMixin)
+_column_names = {}
+
 class SQLAlchemyMixin(object):
     def __init__(self, **kw):
         for k, v in kw.iteritems():
@@ -11,10 +14,15 @@ class SQLAlchemyMixin(object):
         return self.__unicode__().encode('utf8')
 
     def __unicode__(self):
-        repr = u'<%s' % self.__class__.__name__
-        table = sqlalchemy.orm.class_mapper(self.__class__).mapped_table
-        for col in table.c:
-            repr += u' %s=%s' % (col.name, getattr(self, col.name))
+        cls = self.__class__
+        names = _column_names.get(cls)
+        if names is None:
+            table = sqlalchemy.orm.class_mapper(cls).mapped_table
+            names = [ col.name for col in table.c ]
+            _column_names[cls] = names
+        repr = u'<%s' % cls.__name__
+        for name in names:
+            repr += u' %s=%s' % (name, getattr(self, name))
         repr += '>'
         return repr
 
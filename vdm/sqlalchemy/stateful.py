@@ -155,79 +155,182 @@ class StatefulList(StatefulProxy):
         undelete the existing PackageTag rather than adding this new one. But
         what do we with this pkgtag2? We need to 'get rid of it' so it is not
         committed into the the db.
+
+        @param watch: function taking this list, called when which items are
+        active has been worked out, which makes sure changed() gets called
+        whenever items change state or target changes other than through
+        this list and returns a function saying whether what was worked out
+        can (still) be used (or None if it cannot be kept at all). This is
+        opt-in: without one which items are active is worked out every time
+        it is needed, so len and indexing walk the whole of target. (See
+        make_m2m_watch for one for SQLAlchemy collections, which
+        add_stateful_m2m uses.)
         '''
         super(StatefulList, self).__init__(target, **kwargs)
         identifier = kwargs.get('identifier', lambda x: x)
         unneeded_deleter = kwargs.get('unneeded_deleter', lambda x: None)
         self._identifier = identifier
         self._unneeded_deleter = unneeded_deleter
-        self._identity_map = {}
-        for obj in self.target:
-            self._add_to_identity_map(obj)
+        # identity map of target (see _get_identity_map)
+        self._identity_map = None
+        self._identity_map_len = None
+        # positions in target of the items in this list (see _positions)
+        self._watch = kwargs.get('watch', None)
+        self._active_positions = None
+        self._positions_len = None
+        self._keep_positions = None
+
+    def changed(self):
+        '''Forget which items are active (see watch).'''
+        self._active_positions = None
+
+    def _positions(self):
+        '''Positions in target of the items in this list.
+
+        Worked out every time unless we are told when it may change (see
+        watch).
+        '''
+        positions = self._active_positions
+        if positions is None or self._positions_len != len(self.target) or \
+                not self._keep_positions():
+            self._active_positions = None
+            positions = [ ii for ii, item in enumerate(self.target)
+                    if self._is_active(item) ]
+            keep = self._watch and self._watch(self)
+            if keep:
+                self._active_positions = positions
+                self._positions_len = len(self.target)
+                self._keep_positions = keep
+        return positions
 
     def _get_base_index(self, idx):
-        # if we knew items were unique could do
-        # return self.target.index(self[myindex])
-        count = -1
-        basecount = -1
-        if idx < 0:
-            myindex = -(idx) - 1
-            tbaselist = reversed(self.target)
-        else:
-            myindex = idx
-            tbaselist = self.target
-        for item in tbaselist:
-            basecount += 1
-            if self._is_active(item):
-                count += 1
-            if count == myindex:
-                if idx < 0:
-                    return -(basecount + 1)
-                else:
-                    return basecount
-        raise IndexError
+        try:
+            return self._positions()[idx]
+        except IndexError:
+            raise IndexError
+
+    def _get_identity_map(self):
+        '''Items of target by identifier.
+
+        Finding a deleted item to revive is a dict lookup (and a look at the
+        items sharing its identifier) but where it is in target is not kept:
+        removing it (to move it) is linear as deleting from target is anyway.
+
+        Only needed when changing the list so built on the first change.
+        Changes made through this list keep it up to date (see _changed) and
+        it is built again if target changes length behind our back. Which
+        items are deleted is checked when looking so changes of state do not
+        matter.
+        '''
+        if self._identity_map is None or \
+                self._identity_map_len != len(self.target):
+            self._identity_map = {}
+            for obj in self.target:
+                self._add_to_identity_map(obj)
+        return self._identity_map
+
+    def _changed(self):
+        self.changed()
+        # we kept the identity map up to date ourselves
+        self._identity_map_len = len(self.target)
 
     def _add_to_identity_map(self, obj):
         objkey = self._identifier(obj)
-        current = self._identity_map.get(objkey, [])
-        current.append(obj)
-        self._identity_map[objkey] = current
+        self._identity_map.setdefault(objkey, []).append(obj)
 
     def _existing_deleted_obj(self, objkey):
         for existing_obj in self._identity_map.get(objkey, []):
             if not self._is_active(existing_obj): # return 1st we find
                 return existing_obj
 
-    def _check_for_existing_on_add(self, obj):
+    def _reuse_existing(self, obj):
+        '''Return the object to add in place of obj (undeleted) and whether
+        it is an existing (deleted) object already in the list.'''
         objkey = self._identifier(obj)
         out_obj = self._existing_deleted_obj(objkey)
-        if out_obj is None: # no existing deleted object in list
+        existing = out_obj is not None
+        if not existing: # no existing deleted object in list
             out_obj = obj 
             self._add_to_identity_map(out_obj)
-        else: # deleted object already in list
-            # we are about to re-add (in active state) so must remove it first
-            idx = self.target.index(out_obj)
-            del self.target[idx]
+        elif out_obj is not obj: # deleted object already in list
             # We now have have to deal with original `obj` that was passed in
             self._unneeded_deleter(obj)
-
         self._undelete(out_obj)
+        return out_obj, existing
+
+    def _check_for_existing_on_add(self, obj):
+        out_obj, existing = self._reuse_existing(obj)
+        if existing:
+            # we are about to re-add (in active state) so must remove it first
+            # (finding it is linear but then so is deleting from a list)
+            del self.target[self.target.index(out_obj)]
         return out_obj
 
     def append(self, in_obj):
-        obj = self._check_for_existing_on_add(in_obj)
+        self._get_identity_map()
+        obj, existing = self._reuse_existing(in_obj)
+        if existing:
+            # moves to the end
+            del self.target[self.target.index(obj)]
         self.target.append(obj)
+        self._changed()
+
+    def _replace(self, start, stop, values):
+        '''Replace items start to stop of this list with values.
+
+        Same as deleting the items one by one and then inserting the values
+        one by one at start but works out what to delete, undelete and add in
+        one go (rather than for every item).
+        '''
+        positions = self._positions()
+        self._get_identity_map()
+        start = min(max(start, 0), len(positions))
+        stop = min(max(stop, start), len(positions))
+        # values go in front of what will be the item at start afterwards
+        anchor = None
+        if stop < len(positions):
+            anchor = self.target[positions[stop]]
+        for obj in [ self.target[pos] for pos in positions[start:stop] ]:
+            self._delete(obj)
+        new_objs = []
+        # existing objects we undeleted move to their new place
+        moved = set()
+        for value in values:
+            obj, existing = self._reuse_existing(value)
+            new_objs.append(obj)
+            if existing:
+                moved.add(id(obj))
+        if moved:
+            for idx in reversed(xrange(len(self.target))):
+                if id(self.target[idx]) in moved:
+                    del self.target[idx]
+        if anchor is None:
+            self.target.extend(new_objs)
+        elif new_objs:
+            idx = self.target.index(anchor)
+            self.target[idx:idx] = new_objs
+        self._changed()
 
     def insert(self, index, value):
         # have some choice here so just for go for first place
+        self._get_identity_map()
         our_obj = self._check_for_existing_on_add(value)
-        try:
-            baseindex = self._get_base_index(index)
-        except IndexError: # may be list is empty ...
-            baseindex = len(self)
+        self.changed()
+        # same as list.insert: indices out of range go at either end
+        positions = self._positions()
+        if index < 0:
+            index = max(index + len(positions), 0)
+        if index < len(positions):
+            baseindex = positions[index]
+        else:
+            baseindex = len(self.target)
         self.target.insert(baseindex, our_obj)
+        self._changed()
 
     def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ self.base_modifier(self.target[baseindex])
+                    for baseindex in self._positions()[index] ]
         baseindex = self._get_base_index(index)
         return self.base_modifier(self.target[baseindex])
     
@@ -236,49 +339,38 @@ class StatefulList(StatefulProxy):
     
     def __delitem__(self, index):
         if not isinstance(index, slice):
-            self._delete(self[index])
+            self._delete(self.target[self._get_base_index(index)])
+            self.changed()
         else:
-            start = index.start
-            end = index.stop
-            rng = range(start, end)
-            for ii in rng:
-                del self[start]
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                self._replace(start, stop, [])
+            else:
+                # later indices first so earlier ones stay put
+                for ii in sorted(range(start, stop, step), reverse=True):
+                    del self[ii]
 
     def __setitem__(self, index, value):
         if not isinstance(index, slice):
+            if index < 0:
+                # the same place once the item there is gone
+                index += len(self)
             del self[index]
             self.insert(index, value)
         else:
-            if index.stop is None:
-                stop = len(self)
-            elif index.stop < 0:
-                stop = len(self) + index.stop
-            # avoid weird MemoryError when doing OurList[:] = ...
-            elif index.stop > len(self):
-                stop = len(self)
-            else:
-                stop = index.stop
-            step = index.step or 1
-
-            rng = range(index.start or 0, stop, step)
+            start, stop, step = index.indices(len(self))
             if step == 1:
-                # delete first then insert to avoid problems with indices and
-                # statefulness
-                for ii in rng:
-                    start = rng[0]
-                    del self[start]
-                ii = index.start or 0
-                for item in value:
-                    self.insert(ii, item)
-                    ii += 1
+                self._replace(start, max(stop, start), list(value))
             else:
+                value = list(value)
+                rng = range(start, stop, step)
                 if len(value) != len(rng):
                     raise ValueError(
                                 'attempt to assign sequence of size %s to '
                                 'extended slice of size %s' % (len(value),
                                                                len(rng)))
-                    for ii, item in zip(rng, value):
-                        self[ii] = item
+                for ii, item in zip(rng, value):
+                    self[ii] = item
 
     # def __setslice__(self, start, end, values):
     #    for ii in range(start, end):
@@ -290,7 +382,7 @@ class StatefulList(StatefulProxy):
         return myiter
     
     def __len__(self):
-        return sum([1 for _ in self])
+        return len(self._positions())
 
     def count(self, item):
         myiter = itertools.ifilter(lambda v: v == item, iter(self))
@@ -298,8 +390,7 @@ class StatefulList(StatefulProxy):
         return sum(counter)
 
     def extend(self, values):
-        for val in values:
-            self.append(val)
+        self._replace(len(self), len(self), list(values))
 
     def copy(self):
         return list(self)
@@ -425,13 +516,16 @@ class DeferredProperty(object):
             # return cached instance
             return getattr(obj, self.cached_instance_key)
         except AttributeError:
-            # probably should do this using lazy_collections a la assoc proxy
-            target_collection = getattr(obj, self.target_collection_name)
-            stateful_list = self.stateful_class(target_collection, **self.cached_kwargs)
+            stateful_list = self._create(obj)
             # cache
             setattr(obj, self.cached_instance_key, stateful_list)
             return stateful_list
 
+    def _create(self, obj):
+        # probably should do this using lazy_collections a la assoc proxy
+        target_collection = getattr(obj, self.target_collection_name)
+        return self.stateful_class(target_collection, **self.cached_kwargs)
+
     def __set__(self, obj, values):
         # Must not replace the StatefulList object with a list,
         # so instead replace the values in the Stateful list with
@@ -453,6 +547,322 @@ class OurAssociationProxy(sqlalchemy.ext.associationproxy.AssociationProxy):
         return False
 
 
+from sqlalchemy import not_, or_
+from sqlalchemy.orm import object_mapper, object_session
+from sqlalchemy.orm.attributes import instance_state, PASSIVE_NO_FETCH
+
+class StatefulQuery(StatefulProxy):
+    '''Stateful view of a relation (collection) of mapped objects which
+    filters on state in SQL rather than loading the whole collection (deleted
+    objects and all) and filtering in python.
+
+    len() (or count() with no arguments) and slices are done in the database
+    and append and extend only look up the objects they may undelete. Like
+    SQLAlchemy dynamic relations what the queries see relies on autoflush.
+
+    Otherwise it behaves as (and when the collection is already loaded, the
+    object is not in the database yet or use_query says no, is) a
+    StatefulList on the collection.
+    '''
+    list_class = StatefulList
+
+    # or_ of at most this many identifier clauses per query
+    chunk_size = 200
+
+    def __init__(self, target, collection_name, **kwargs):
+        '''Same as for StatefulList except that target is the object with
+        the collection (rather than the collection) plus:
+
+        @param collection_name: name of the collection (relation) on target.
+        @param active_clause: function returning an SQL criterion for objects
+            being active (defaults to the active_clause classmethod of the
+            collection's class).
+        @param identifier_clause: function taking an object and returning an
+            SQL criterion for objects with the same identifier (or None if
+            there cannot be any in the database).
+        @param use_query: function taking target and returning whether to
+            query (e.g. only at HEAD).
+        '''
+        super(StatefulQuery, self).__init__(target, **kwargs)
+        self.collection_name = collection_name
+        self._identifier = kwargs.get('identifier', lambda x: x)
+        self._unneeded_deleter = kwargs.get('unneeded_deleter',
+                lambda x: None)
+        self._active_clause = kwargs.get('active_clause',
+                lambda: self._item_class().active_clause())
+        self._identifier_clause = kwargs.get('identifier_clause',
+                lambda x: None)
+        self._use_query = kwargs.get('use_query', lambda x: True)
+        self._list_kwargs = kwargs
+        self._list = None
+
+    def _item_class(self):
+        prop = object_mapper(self.target).get_property(self.collection_name)
+        return prop.mapper.class_
+
+    def _clause(self):
+        return self._active_clause()
+
+    def _query(self, clause):
+        '''Query for objects of the collection matching clause (None if we
+        have to use the collection).'''
+        state = instance_state(self.target)
+        if state.key is None or self.collection_name in state.dict:
+            return None
+        sess = object_session(self.target)
+        if sess is None or not self._use_query(self.target):
+            return None
+        prop = object_mapper(self.target).get_property(self.collection_name)
+        order_by = prop.order_by or prop.mapper.primary_key
+        return sess.query(prop.mapper.class_).with_parent(self.target,
+                self.collection_name).filter(clause).order_by(*order_by)
+
+    def query(self):
+        '''Query for the objects in this list (None if the collection is
+        used instead).'''
+        return self._query(self._clause())
+
+    def _loaded(self):
+        '''StatefulList on the (loaded) collection.'''
+        collection = getattr(self.target, self.collection_name)
+        if self._list is None or self._list.target is not collection:
+            self._list = self.list_class(collection, **self._list_kwargs)
+        return self._list
+
+    def _get(self, query, index):
+        '''Objects (not base_modified) at index.'''
+        if isinstance(index, slice):
+            if index.step in (None, 1) and (index.start or 0) >= 0 and \
+                    (index.stop is None or index.stop >= 0):
+                # LIMIT/OFFSET
+                return query[index]
+            return query.all()[index]
+        if index < 0:
+            index += len(self)
+        results = []
+        if index >= 0:
+            results = query.offset(index).limit(1).all()
+        if not results:
+            raise IndexError(index)
+        return results[0]
+
+    def __getitem__(self, index):
+        query = self.query()
+        if query is None:
+            return self._loaded()[index]
+        if isinstance(index, slice):
+            return [ self.base_modifier(obj)
+                    for obj in self._get(query, index) ]
+        return self.base_modifier(self._get(query, index))
+
+    def __iter__(self):
+        query = self.query()
+        if query is None:
+            return iter(self._loaded())
+        return iter(query.all())
+
+    def __len__(self):
+        query = self.query()
+        if query is None:
+            return len(self._loaded())
+        return query.order_by(None).count()
+
+    def count(self, *args):
+        '''With no arguments the number of objects (as for a query)
+        otherwise how many times the item given is in the list.'''
+        if not args:
+            return len(self)
+        return len([ obj for obj in self if obj == args[0] ])
+
+    def _existing_deleted_objs(self, values):
+        '''Objects not in this list with the same identifier as values
+        (see StatefulList._existing_deleted_obj).'''
+        clauses = [ clause for clause in map(self._identifier_clause, values)
+                if clause is not None ]
+        existing = {}
+        for ii in range(0, len(clauses), self.chunk_size):
+            query = self._query(not_(self._clause())).filter(
+                    or_(*clauses[ii:ii+self.chunk_size]))
+            for obj in query:
+                existing.setdefault(self._identifier(obj), []).append(obj)
+        return existing
+
+    def _add(self, obj):
+        # add to the collection without loading it (as a backref does)
+        state = instance_state(self.target)
+        impl = state.manager[self.collection_name].impl
+        impl.append(state, state.dict, obj, None, passive=PASSIVE_NO_FETCH)
+
+    def append(self, obj):
+        self.extend([obj])
+
+    def extend(self, values):
+        values = list(values)
+        if self.query() is None:
+            return self._loaded().extend(values)
+        existing = self._existing_deleted_objs(values)
+        for value in values:
+            bucket = existing.get(self._identifier(value))
+            if bucket:
+                obj = bucket.pop(0)
+                if obj is not value:
+                    self._unneeded_deleter(value)
+                self._undelete(obj)
+            else:
+                self._undelete(value)
+                self._add(value)
+
+    def insert(self, index, value):
+        self._loaded().insert(index, value)
+
+    def __delitem__(self, index):
+        query = self.query()
+        if query is None:
+            del self._loaded()[index]
+            return
+        if isinstance(index, slice):
+            objs = self._get(query, index)
+        else:
+            objs = [self._get(query, index)]
+        for obj in objs:
+            self._delete(obj)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice) and not index.start and \
+                index.stop is None and index.step is None and \
+                self.query() is not None:
+            # replacing the lot
+            self.clear()
+            self.extend(value)
+        else:
+            self._loaded()[index] = value
+
+    def clear(self):
+        query = self.query()
+        if query is None:
+            return self._loaded().clear()
+        for obj in query.all():
+            self._delete(obj)
+
+    def copy(self):
+        return list(self)
+
+    def pop(self, index=None):
+        raise NotImplementedError
+
+    def reverse(self):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class StatefulQueryDeleted(StatefulQuery):
+    list_class = StatefulListDeleted
+
+    def _set_stateful_operators(self):
+        self._is_active = lambda x: not self.is_active(self.base_modifier(x))
+        self._delete = self.undelete
+        self._undelete = self.delete
+
+    def _clause(self):
+        return not_(self._active_clause())
+
+
+class QueryProperty(DeferredProperty):
+    '''DeferredProperty for StatefulQuery (which gets the object rather than
+    the collection).'''
+    def _create(self, obj):
+        return self.stateful_class(obj, self.target_collection_name,
+                **self.cached_kwargs)
+
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as _Session
+from sqlalchemy.orm.attributes import QueryableAttribute
+from sqlalchemy.orm.collections import collection_adapter
+
+# Stateful lists to tell (see StatefulList watch) are kept on the session of
+# the objects whose changes they need to know about (so, like the session,
+# only used by one thread), keyed by those objects.
+
+def _session_watchers(session, create=False):
+    watchers = getattr(session, '_vdm_stateful_watchers', None)
+    if watchers is None and create:
+        watchers = weakref.WeakKeyDictionary()
+        session._vdm_stateful_watchers = watchers
+    return watchers
+
+def _tell_session_watchers(session, obj):
+    watchers = session is not None and _session_watchers(session)
+    if watchers:
+        for stateful_list in list(watchers.pop(obj, ())):
+            stateful_list.changed()
+
+def _tell_watchers(obj, *args):
+    _tell_session_watchers(object_session(obj), obj)
+
+# lists cannot hear about objects once they leave the session
+event.listen(_Session, 'persistent_to_detached', _tell_session_watchers)
+event.listen(_Session, 'pending_to_transient', _tell_session_watchers)
+
+def make_m2m_watch(object_to_alter, m2m_object, basic_m2m_name, use_query):
+    '''Make a watch (see StatefulList) for stateful lists on collection
+    basic_m2m_name of object_to_alter holding m2m_object objects whose state
+    attribute says whether they are active.
+
+    Only the lists on the collection (or holding the object) changed hear
+    about it. What they work out is only kept while the owner of the
+    collection and all the items are in the same session and
+    use_query(owner) says so (other things, e.g. the revision being looked
+    at, matter otherwise).
+    '''
+    listening = []
+    def listen():
+        # mappers may only be set up after add_stateful_m2m
+        state_attr = getattr(m2m_object, 'state', None)
+        if not isinstance(state_attr, QueryableAttribute):
+            return False
+        if not listening:
+            collection = getattr(object_to_alter, basic_m2m_name)
+            event.listen(collection, 'append', _tell_watchers, propagate=True)
+            event.listen(collection, 'remove', _tell_watchers, propagate=True)
+            event.listen(state_attr, 'set', _tell_watchers, propagate=True)
+            # state may be different when loaded again
+            event.listen(m2m_object, 'expire', _tell_watchers, propagate=True)
+            event.listen(m2m_object, 'refresh', _tell_watchers,
+                    propagate=True)
+            listening.append(True)
+        return True
+
+    def watch(stateful_list):
+        adapter = collection_adapter(stateful_list.target)
+        owner = adapter and adapter.owner_state.obj()
+        if owner is None or not use_query(owner) or not listen():
+            return None
+        session = object_session(owner)
+        if session is None:
+            return None
+        for item in stateful_list.target:
+            if object_session(item) is not session:
+                return None
+        watchers = _session_watchers(session, create=True)
+        for obj in [owner] + list(stateful_list.target):
+            if obj in watchers:
+                watchers[obj].add(stateful_list)
+            else:
+                watchers[obj] = weakref.WeakSet([stateful_list])
+        owner_ref = weakref.ref(owner)
+        session_ref = weakref.ref(session)
+        def keep():
+            owner = owner_ref()
+            return owner is not None and \
+                    object_session(owner) is session_ref() and \
+                    use_query(owner)
+        return keep
+    return watch
+
+
 # TODO: 2009-07-24 support dict collections
 def add_stateful_m2m(object_to_alter, m2m_object, m2m_property_name,
         attr, basic_m2m_name, **kwargs):
@@ -490,8 +900,12 @@ def add_stateful_m2m(object_to_alter, m2m_object, m2m_property_name,
 
     @param attr: the name of the attribute on the Join object corresponding to
         the target (e.g. in this case 'license' on PackageLicense).
+    @param query_backed: use StatefulQuery (filtering on state in SQL) rather
+        than StatefulList for licenses_active and licenses_deleted. Worth it
+        when there are many join objects (e.g. many deleted ones).
     @arg **kwargs: these are passed on to the DeferredProperty.
     '''
+    query_backed = kwargs.pop('query_backed', False)
     active_name = m2m_property_name + '_active'
     # in the join object (e.g. PackageLicense) the License object accessible by
     # the license attribute will be what we need for our identity map
@@ -511,17 +925,46 @@ def add_stateful_m2m(object_to_alter, m2m_object, m2m_property_name,
             if sess: # for tests at least must support obj not being sqlalchemy
                 sess.expunge(obj_to_delete)
         kwargs['unneeded_deleter'] = _f
-
-    active_prop = DeferredProperty(basic_m2m_name, StatefulList, **kwargs)
+    if query_backed and not 'identifier_clause' in kwargs:
+        def identifier_clause(joinobj):
+            target = getattr(joinobj, attr)
+            if target is None or instance_state(target).key is None:
+                # not in the database so no join objects there have it
+                return None
+            return getattr(m2m_object, attr) == target
+        kwargs['identifier_clause'] = identifier_clause
+    if not 'watch' in kwargs and not 'is_active' in kwargs and \
+            getattr(m2m_object, '__stateful__', False):
+        # join objects are active or not according to their state (see
+        # vdm.sqlalchemy.StatefulObjectMixin)
+        kwargs['watch'] = make_m2m_watch(object_to_alter, m2m_object,
+                basic_m2m_name, kwargs.get('use_query', lambda obj: True))
+
+    if query_backed:
+        active_prop = QueryProperty(basic_m2m_name, StatefulQuery, **kwargs)
+        deleted_prop = QueryProperty(basic_m2m_name, StatefulQueryDeleted,
+                **kwargs)
+    else:
+        active_prop = DeferredProperty(basic_m2m_name, StatefulList,
+                **kwargs)
+        deleted_prop = DeferredProperty(basic_m2m_name, StatefulListDeleted,
+                **kwargs)
     deleted_name = m2m_property_name + '_deleted'
-    deleted_prop = DeferredProperty(basic_m2m_name, StatefulListDeleted,
-            **kwargs)
     setattr(object_to_alter, active_name, active_prop)
     setattr(object_to_alter, deleted_name, deleted_prop)
     create_m2m = make_m2m_creator_for_assocproxy(m2m_object, attr)
+    def bulk_set(proxy, values):
+        # (after clearing) all in one go rather than appending one by one
+        proxy.col.extend([ create_m2m(value) for value in values ])
     setattr(object_to_alter, m2m_property_name,
-            OurAssociationProxy(active_name, attr, creator=create_m2m)
+            OurAssociationProxy(active_name, attr, creator=create_m2m,
+                proxy_bulk_set=bulk_set)
             )
+    # record what we did (e.g. for vdm.sqlalchemy.prefetch_as_of)
+    # NB: not shared with any base class
+    m2ms = dict(object_to_alter.__dict__.get('__stateful_m2m__', {}))
+    m2ms[m2m_property_name] = (m2m_object, attr, basic_m2m_name)
+    object_to_alter.__stateful_m2m__ = m2ms
 
 
 def make_m2m_creator_for_assocproxy(m2m_object, attrname):
@@ -0,0 +1,57 @@
+'''Many threads, each with its own session, writing revisions at once.
+
+Uses a SQLite database file (rather than the demo database) so that the
+test can be run anywhere.
+'''
+import os
+import shutil
+import tempfile
+
+from sqlalchemy.orm import sessionmaker
+from demo import *
+from benchmark import sqlite_file_engine, run_writers
+
+NUM_REVISIONS = 10
+PACKAGES_PER_REVISION = 5
+
+
+class TestConcurrentWriters:
+    @classmethod
+    def setup_class(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = sqlite_file_engine(os.path.join(self.tmpdir, 'vdm.db'))
+        self.make_session = sessionmaker(bind=self.engine, autoflush=True,
+                autocommit=False)
+
+    @classmethod
+    def teardown_class(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, num_threads):
+        metadata.drop_all(bind=self.engine)
+        metadata.create_all(bind=self.engine)
+        errors, seconds = run_writers(self.make_session, num_threads,
+                NUM_REVISIONS, PACKAGES_PER_REVISION)
+        assert not errors, errors
+        num_revisions = num_threads * NUM_REVISIONS
+        session = self.make_session()
+        assert session.query(Revision).count() == num_revisions
+        pkgs = session.query(Package).all()
+        assert len(pkgs) == num_threads * PACKAGES_PER_REVISION
+        for pkg in pkgs:
+            # no lost object revisions
+            assert len(pkg.all_revisions) == NUM_REVISIONS, pkg
+            assert pkg.title == u'%s' % (NUM_REVISIONS - 1)
+            assert pkg.all_revisions[0].title == pkg.title
+            assert pkg.all_revisions[0].revision_id == pkg.revision_id
+            authors = set([ pkgrev.revision.author
+                for pkgrev in pkg.all_revisions ])
+            assert authors == set([pkg.name.split('-')[0]]), authors
+        session.close()
+
+    def test_1_thread(self):
+        self.check(1)
+
+    def test_8_threads(self):
+        self.check(8)
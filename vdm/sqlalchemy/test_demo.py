@@ -7,6 +7,7 @@ from sqlalchemy.orm import object_session, class_mapper
 
 import vdm.sqlalchemy
 from demo import *
+from benchmark import StatementCounter
 
 from sqlalchemy import __version__ as sqav
 if sqav.startswith("0.4"):
@@ -122,6 +123,29 @@ class Test_02_Versioning:
         revs = [ pr.revision for pr in p1.all_revisions ]
         assert revs[0].timestamp > revs[1].timestamp, revs
 
+    def test_get_revisions(self):
+        p1 = Session.query(Package).filter_by(name=self.name1).one()
+        counter = StatementCounter(engine)
+        counter.start()
+        revobjs = p1.get_revisions()
+        # revisions are loaded with the object revisions
+        timestamps = [ pr.revision.timestamp for pr in revobjs ]
+        counter.stop()
+        assert len(counter.statements) == 1, counter.statements
+        assert [ pr.revision_id for pr in revobjs ] == [self.rev2_id,
+                self.rev1_id]
+        assert timestamps[0] > timestamps[1]
+        latest = p1.get_revisions(limit=1)
+        assert [ pr.revision_id for pr in latest ] == [self.rev2_id]
+        older = p1.get_revisions(limit=1, offset=1)
+        assert [ pr.revision_id for pr in older ] == [self.rev1_id]
+        cursor = Package.revisions_cursor(latest[0])
+        older = p1.get_revisions(before=cursor)
+        assert [ pr.revision_id for pr in older ] == [self.rev1_id]
+        cursor = Package.revisions_cursor(older[0])
+        assert p1.get_revisions(before=cursor) == []
+        Session.remove()
+
     def test_basic_2(self):
         # should be at HEAD (i.e. rev2) by default 
         p1 = Session.query(Package).filter_by(name=self.name1).one()
@@ -170,6 +194,140 @@ class Test_02_Versioning:
         p1r1 = p1.get_as_of(rev1)
         assert p1r1.license.open == True
 
+    def test_get_as_of_unchanged_since(self):
+        lic1 = Session.query(License).filter_by(name='blah').one()
+        p1 = Session.query(Package).filter_by(name=self.name1).one()
+        rev1 = Session.query(Revision).get(self.rev1_id)
+        rev2 = Session.query(Revision).get(self.rev2_id)
+        head = vdm.sqlalchemy.base.stats['get_as_of.head']
+        counter = StatementCounter(engine)
+        counter.start()
+        lic1r2 = lic1.get_as_of(rev2)
+        counter.stop()
+        # lic1 not changed in rev2 so the continuity is the answer
+        assert counter.statements == [], counter.statements
+        assert vdm.sqlalchemy.base.stats['get_as_of.head'] == head + 1
+        assert lic1r2.name == 'blah'
+        assert lic1r2.revision_id == self.rev1_id
+        assert lic1r2.revision == rev1
+        assert lic1r2.continuity == lic1
+        assert lic1r2 not in Session
+        # p1 was changed in rev2
+        p1r1 = p1.get_as_of(rev1)
+        assert vdm.sqlalchemy.base.stats['get_as_of.head'] == head + 1
+        assert p1r1.title == self.title1
+        Session.remove()
+
+    def test_get_as_of_cache(self):
+        stats = vdm.sqlalchemy.base.stats
+        p1 = Session.query(Package).filter_by(name=self.name1).one()
+        rev1 = Session.query(Revision).get(self.rev1_id)
+        p1r1 = p1.get_as_of(rev1)
+        assert p1r1.license.open == True
+        hits = stats['get_as_of.cache_hit']
+        counter = StatementCounter(engine)
+        counter.start()
+        assert p1.get_as_of(rev1) is p1r1
+        # fake relation resolves license as of rev1 again
+        assert p1r1.license.open == True
+        counter.stop()
+        assert counter.statements == [], counter.statements
+        assert stats['get_as_of.cache_hit'] == hits + 2
+        # new revision on the session
+        rev2 = Session.query(Revision).get(self.rev2_id)
+        vdm.sqlalchemy.SQLAlchemySession.set_revision(Session, rev2)
+        misses = stats['get_as_of.cache_miss']
+        p1.get_as_of(rev1)
+        assert stats['get_as_of.cache_miss'] == misses + 1
+        Session.rollback()
+        p1.get_as_of(rev1)
+        assert stats['get_as_of.cache_miss'] == misses + 2
+        Session.remove()
+
+    def _fake_relations(self, revision_id, prefetch):
+        Session.remove()
+        revobjs = Session.query(PackageRevision).all()
+        if revision_id:
+            rev = Session.query(Revision).get(revision_id)
+            vdm.sqlalchemy.SQLAlchemySession.set_revision(Session, rev)
+            vdm.sqlalchemy.SQLAlchemySession.set_not_at_HEAD(Session)
+        counter = StatementCounter(engine)
+        if prefetch:
+            counter.start()
+            vdm.sqlalchemy.prefetch_as_of(revobjs, ['license', 'tags'])
+            counter.stop()
+            assert len(counter.statements) <= 6, counter.statements
+        counter.start()
+        out = [ (revobj.license and revobj.license.name,
+            [ tag.name for tag in revobj.tags ]) for revobj in revobjs ]
+        counter.stop()
+        Session.remove()
+        return out, counter
+
+    def test_prefetch_as_of(self):
+        for revision_id in (self.rev1_id, self.rev2_id, None):
+            expected, counter = self._fake_relations(revision_id, False)
+            assert len(counter.statements) > 4
+            out, counter = self._fake_relations(revision_id, True)
+            assert out == expected, (out, expected)
+            assert counter.statements == [], counter.statements
+
+    def _head_view_and_older(self, prefetch):
+        p1 = Session.query(Package).filter_by(name=self.name1).one()
+        rev1 = Session.query(Revision).get(self.rev1_id)
+        rev2 = Session.query(Revision).get(self.rev2_id)
+        # p1 not changed since rev2 so that is a (transient) view of it
+        view = p1.get_as_of(rev2)
+        assert view not in Session
+        older = p1.get_as_of(rev1)
+        assert older in Session
+        if prefetch:
+            vdm.sqlalchemy.prefetch_as_of([view, older], ['license', 'tags'])
+        out = [ (revobj.license.name, [ tag.name for tag in revobj.tags ])
+                for revobj in (view, older) ]
+        Session.remove()
+        return out
+
+    def test_prefetch_as_of_head_views(self):
+        expected = self._head_view_and_older(False)
+        assert self._head_view_and_older(True) == expected
+
+    def test_get_many_as_of(self):
+        p1 = Session.query(Package).filter_by(name=self.name1).one()
+        p2 = Session.query(Package).filter_by(name=self.name2).one()
+        rev1 = Session.query(Revision).get(self.rev1_id)
+        rev2 = Session.query(Revision).get(self.rev2_id)
+        counter = StatementCounter(engine)
+        counter.start()
+        out = Package.get_many_as_of([p1, p2.id, u'nosuchid'], rev1)
+        counter.stop()
+        assert len(counter.on_table('package_revision')) == 1, \
+                counter.statements
+        assert out[u'nosuchid'] is None
+        assert out[p1.id].title == self.title1
+        assert out[p2.id].state == State.ACTIVE
+        out = Package.get_many_as_of([p1, p2], rev2)
+        assert out[p1.id].title == self.title2
+        assert out[p2.id].state == State.DELETED
+        assert out[p1.id].revision_id == self.rev2_id
+        lics = Session.query(License).all()
+        out = License.get_many_as_of(lics, rev2)
+        # license 1 was not changed in rev2
+        assert len(out) == 2
+        for lic in lics:
+            assert out[lic.id].continuity == lic
+        # just ids and a revision not in the session
+        Session.expunge(rev1)
+        try:
+            Package.get_many_as_of([p2.id], rev1)
+        except ValueError:
+            pass
+        else:
+            assert False, 'should have raised'
+        out = Package.get_many_as_of([p2.id], rev1, session=Session)
+        assert out[p2.id].state == State.ACTIVE
+        Session.remove()
+
     def test_versioning_m2m_1(self):
         p1 = Session.query(Package).filter_by(name=self.name1).one()
         rev1 = Session.query(Revision).get(self.rev1_id)
@@ -411,6 +569,35 @@ class Test_04_StatefulVersioned2:
         self._test_package_tags()
         self._test_tags()
 
+    def test_5_state_set_directly(self):
+        rev2 = repo.new_revision()
+        p1 = Session.query(Package).filter_by(name=self.name1).one()
+        p2 = Package(name=u'bob')
+        p2.tags.append(Session.query(Tag).filter_by(name='geo').one())
+        Session.add(p2)
+        assert len(p1.tags_active) == 1
+        assert len(p2.tags_active) == 1
+        p1.package_tags[0].state = State.DELETED
+        assert len(p1.tags_active) == 0
+        assert len(p1.tags_deleted) == 1
+        assert len(p1.tags) == 0
+        # only the list holding it is told
+        assert p2.tags_active._active_positions is not None
+        assert len(p2.tags) == 1
+        # kept on the session
+        assert p2 in Session()._vdm_stateful_watchers
+        repo.commit_and_remove()
+        p1 = Session.query(Package).filter_by(name=self.name1).one()
+        assert len(p1.tags) == 0
+        p2 = Session.query(Package).filter_by(name=u'bob').one()
+        assert len(p2.tags) == 1
+        # changes cannot be heard about once out of the session
+        pkgtag = p2.package_tags[0]
+        Session.expunge(pkgtag)
+        pkgtag.state = State.DELETED
+        assert len(p2.tags) == 0
+        Session.remove()
+
 
 class Test_05_RevertAndPurge:
 
@@ -474,3 +661,207 @@ class Test_05_RevertAndPurge:
         pkgrevs = Session.query(PackageRevision).all()
         assert len(pkgrevs) == 2, pkgrevs
 
+
+
+class Test_06_BatchedRevisionRows:
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        self.counter = StatementCounter(engine)
+        self.names = [ u'pkg%s' % ii for ii in range(10) ]
+
+        rev1 = repo.new_revision()
+        self.counter.start()
+        for name in self.names:
+            Session.add(Package(name=name, title=u'first'))
+        repo.commit()
+        self.counter.stop()
+        self.rev1_id = rev1.id
+        self.rev1_statements = list(self.counter.statements)
+        Session.remove()
+
+        # several flushes within one vdm revision
+        rev2 = repo.new_revision()
+        self.rev2_id = rev2.id
+        for pkg in Session.query(Package).all():
+            pkg.title = u'second'
+        Session.flush()
+        self.counter.start()
+        for pkg in Session.query(Package).all():
+            pkg.title = u'third'
+        Session.flush()
+        self.counter.stop()
+        self.rev2_statements = list(self.counter.statements)
+        repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+
+    def test_one_insert_for_all_objects(self):
+        self.counter.statements = self.rev1_statements
+        assert self.counter.count('INSERT INTO package_revision') == 1, \
+                self.rev1_statements
+
+    def test_rows(self):
+        assert Session.query(PackageRevision).count() == 2 * len(self.names)
+        revs = Session.query(PackageRevision).\
+                filter_by(revision_id=self.rev1_id).all()
+        assert len(revs) == len(self.names)
+        assert set([ r.title for r in revs ]) == set([u'first'])
+
+    def test_multiple_flushes_per_revision(self):
+        self.counter.statements = self.rev2_statements
+        assert self.counter.count('INSERT INTO package_revision') == 0
+        assert self.counter.count('UPDATE package_revision') == 1
+        # we know what we wrote in the first flush so no need to check
+        assert not [ s for s in self.counter.on_table('package_revision')
+                if s.startswith('SELECT') ]
+        revs = Session.query(PackageRevision).\
+                filter_by(revision_id=self.rev2_id).all()
+        assert len(revs) == len(self.names)
+        assert set([ r.title for r in revs ]) == set([u'third'])
+
+
+class Test_07_UpsertRevisionRows:
+    '''Writing to a revision which was not created by this session.'''
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        rev1 = repo.new_revision()
+        Session.add(Package(name=u'a', title=u'first'))
+        repo.commit_and_remove()
+        self.rev1_id = rev1.id
+
+        self.counter = StatementCounter(engine)
+        self.counter.start()
+        rev1 = Session.query(Revision).get(self.rev1_id)
+        vdm.sqlalchemy.SQLAlchemySession.set_revision(Session, rev1)
+        pkg = Session.query(Package).filter_by(name=u'a').one()
+        pkg.title = u'second'
+        Session.add(Package(name=u'b', title=u'second'))
+        repo.commit_and_remove()
+        self.counter.stop()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+
+    def test_rows(self):
+        revs = Session.query(PackageRevision).all()
+        assert len(revs) == 2, revs
+        for rev in revs:
+            assert rev.revision_id == self.rev1_id
+            assert rev.title == u'second'
+
+    def test_one_statement(self):
+        stmts = self.counter.on_table('package_revision')
+        assert len(stmts) == 1, stmts
+        assert stmts[0].startswith('INSERT'), stmts
+
+
+class Test_08_ChangeDetectionDoesNotLoad:
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        repo.new_revision()
+        Session.add(Package(name=u'a', title=u'first', notes=u'long notes'))
+        repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+
+    def test_01_no_real_change(self):
+        from sqlalchemy.orm import defer
+        pkg = Session.query(Package).options(defer('notes')).\
+                filter_by(name=u'a').one()
+        rev = repo.new_revision()
+        pkg.title = u'first'
+        counter = StatementCounter(engine)
+        counter.start()
+        Session.flush()
+        counter.stop()
+        # notes was not loaded just to see it had not changed
+        assert not counter.on_table('package'), counter.statements
+        assert 'notes' not in pkg.__dict__
+        repo.commit_and_remove()
+        pkg = Session.query(Package).filter_by(name=u'a').one()
+        assert pkg.revision_id != rev.id
+        assert len(pkg.all_revisions) == 1
+        Session.remove()
+
+    def test_02_change_to_unloaded(self):
+        from sqlalchemy.orm import defer
+        pkg = Session.query(Package).options(defer('notes')).\
+                filter_by(name=u'a').one()
+        rev = repo.new_revision()
+        rev_id = rev.id
+        pkg.notes = u'other notes'
+        repo.commit_and_remove()
+        pkg = Session.query(Package).filter_by(name=u'a').one()
+        assert pkg.revision_id == rev_id
+        assert pkg.all_revisions[0].notes == u'other notes'
+        Session.remove()
+
+
+class Test_09_VersionedM2MAsOf:
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        rev1 = repo.new_revision()
+        pkg = Package(name=u'a')
+        Session.add(pkg)
+        pkg.tags = [ Tag(name=u'tag%s' % ii) for ii in range(3) ]
+        repo.commit_and_remove()
+        rev2 = repo.new_revision()
+        pkg = Session.query(Package).filter_by(name=u'a').one()
+        # one deleted, one taken out of the list altogether
+        ptags = dict([ (pt.tag.name, pt) for pt in pkg.package_tags ])
+        ptags[u'tag0'].delete()
+        pkg.package_tags.remove(ptags[u'tag1'])
+        repo.commit_and_remove()
+        self.rev_ids = [rev1.id, rev2.id]
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+
+    def as_of(self, revision_id):
+        pkg = Session.query(Package).filter_by(name=u'a').one()
+        rev = Session.query(Revision).get(revision_id)
+        return pkg.get_as_of(rev)
+
+    def test_01_past_revision(self):
+        pkgrev = self.as_of(self.rev_ids[0])
+        counter = StatementCounter(engine)
+        counter.start()
+        names = sorted([ tag.name for tag in pkgrev.tags ])
+        counter.stop()
+        # including tag1 which is no longer in the package's list
+        assert names == [u'tag0', u'tag1', u'tag2'], names
+        assert len(counter.on_table('package_tag_revision')) == 1, \
+                counter.statements
+        assert len(pkgrev.tags_active) == 3
+        assert pkgrev.tags_deleted == []
+        Session.remove()
+
+    def test_02_later_revision(self):
+        pkgrev = self.as_of(self.rev_ids[1])
+        names = [ tag.name for tag in pkgrev.tags ]
+        assert names == [u'tag2'], names
+        assert len(pkgrev.tags_deleted) == 1
+        assert pkgrev.tags_deleted[0].tag.name == u'tag0'
+        Session.remove()
+
+    def test_03_head(self):
+        pkg = Session.query(Package).filter_by(name=u'a').one()
+        pkgrev = pkg.all_revisions[0]
+        assert [ tag.name for tag in pkgrev.tags ] == [u'tag2']
+        Session.remove()
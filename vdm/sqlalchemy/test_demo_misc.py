@@ -80,3 +80,15 @@ class TestMisc:
         assert len(table.c.keys()) > 0
         assert 'revision_id' in table.c.keys()
 
+
+    def test_versioned_class_info(self):
+        info = VersionedClassInfo.get(Package)
+        assert info.table is package_table
+        assert info.revision_table is package_revision_table
+        assert info.primary_key == 'id'
+        assert 'notes' in info.fields
+        assert 'revision_id' not in info.fields
+        assert Package.revisioned_fields() == info.fields
+        assert info.statements is RevisionStatements.get(
+                package_revision_table)
+        assert VersionedClassInfo.get(Tag) is None
@@ -0,0 +1,89 @@
+from sqlalchemy.orm import mapper
+from demo import *
+from base import *
+from tools import Repository
+from benchmark import StatementCounter
+
+# a revision table with the revision timestamp copied onto it
+note_table = Table('note', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('text', UnicodeText),
+        )
+make_table_stateful(note_table)
+note_revision_table = make_revisioned_table(note_table,
+        revision_timestamp=True)
+
+class Note(RevisionedObjectMixin, StatefulObjectMixin, SQLAlchemyMixin):
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+mapper(Note, note_table,
+    extension=Revisioner(note_revision_table)
+    )
+modify_base_object_mapper(Note, Revision, State)
+NoteRevision = create_object_version(mapper, Note, note_revision_table)
+
+
+class TestRevisionTimestamp:
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        self.repo = Repository(metadata, Session, versioned_objects=[Note])
+        rev1 = repo.new_revision()
+        Session.add(Note(id=1, text=u'v1'))
+        repo.commit_and_remove()
+        rev2 = repo.new_revision()
+        Session.query(Note).get(1).text = u'v2'
+        repo.commit_and_remove()
+        self.rev_ids = [rev1.id, rev2.id]
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def revisions(self):
+        return [ Session.query(Revision).get(id) for id in self.rev_ids ]
+
+    def test_01_column(self):
+        rev1, rev2 = self.revisions()
+        revobjs = Session.query(NoteRevision).all()
+        timestamps = dict([ (r.revision_id, r.revision_timestamp)
+            for r in revobjs ])
+        assert timestamps == {rev1.id: rev1.timestamp,
+                rev2.id: rev2.timestamp}, timestamps
+        Session.remove()
+
+    def test_02_history_without_join(self):
+        rev1, rev2 = self.revisions()
+        note = Session.query(Note).get(1)
+        counter = StatementCounter(engine)
+        counter.start()
+        try:
+            assert note.diff(rev2)['text'] == '- v1\n+ v2'
+            assert note.get_as_of(rev1).text == u'v1'
+            assert Note.get_many_as_of([1], rev2)[1].text == u'v2'
+        finally:
+            counter.stop()
+        joins = [ s for s in counter.on_table('note_revision')
+                if 'JOIN revision' in s ]
+        assert not joins, joins
+        # revisions are eager loaded for the object revisions we get
+        counter.start()
+        try:
+            revobjs = note.get_revisions(limit=1)
+            assert revobjs[0].revision == rev2
+        finally:
+            counter.stop()
+        assert len(counter.statements) == 1, counter.statements
+        assert [ r.text for r in note.all_revisions ] == [u'v2', u'v1']
+        Session.remove()
+
+    def test_03_backfill(self):
+        Session.execute(note_revision_table.update().values(
+            revision_timestamp=None))
+        Session.commit()
+        assert self.repo.backfill_revision_timestamp() == 2
+        self.test_01_column()
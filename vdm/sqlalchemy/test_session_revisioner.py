@@ -0,0 +1,139 @@
+from sqlalchemy.orm import scoped_session, sessionmaker, mapper
+from demo import *
+from base import *
+
+# not versioned
+site_table = Table('site', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('name', String(100)),
+        )
+
+# a versioned class mapped without a Revisioner extension
+page_table = Table('page', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('name', String(100)),
+        Column('license_id', Integer, ForeignKey('license.id')),
+        Column('site_id', Integer, ForeignKey('site.id')),
+        )
+make_table_stateful(page_table)
+page_revision_table = make_revisioned_table(page_table)
+
+class Page(RevisionedObjectMixin, StatefulObjectMixin, SQLAlchemyMixin):
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+mapper(Page, page_table, properties={
+    'license':relation(License),
+    })
+modify_base_object_mapper(Page, Revision, State)
+PageRevision = create_object_version(mapper, Page, page_revision_table)
+
+class Site(object):
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+# no backref: pages only change through site.pages
+mapper(Site, site_table, properties={
+    'pages':relation(Page),
+    })
+
+PageSession = scoped_session(sessionmaker(autoflush=True, autocommit=False))
+SessionRevisioner().listen(PageSession)
+
+
+class TestSessionRevisioner:
+    @classmethod
+    def setup_class(self):
+        repo.rebuild_db()
+        self.session = PageSession
+        rev = Revision(author=u'tester')
+        SQLAlchemySession.set_revision(self.session, rev)
+        self.lic = License(name=u'gpl')
+        self.session.add(self.lic)
+        self.session.add(Page(name=u'home'))
+        self.session.commit()
+        self.rev1_id = rev.id
+        self.session.remove()
+
+    @classmethod
+    def teardown_class(self):
+        PageSession.remove()
+        repo.rebuild_db()
+
+    def test_01_create(self):
+        page = self.session.query(Page).filter_by(name=u'home').one()
+        assert page.revision_id == self.rev1_id
+        assert len(page.all_revisions) == 1
+        assert page.all_revisions[0].name == u'home'
+        # license has its own Revisioner
+        lic = self.session.query(License).one()
+        assert lic.revision_id == self.rev1_id
+        assert len(lic.all_revisions) == 1
+
+    def test_02_update(self):
+        page = self.session.query(Page).filter_by(name=u'home').one()
+        lic = self.session.query(License).one()
+        rev = Revision(author=u'tester')
+        SQLAlchemySession.set_revision(self.session, rev)
+        page.name = u'home2'
+        self.session.flush()
+        # relation changes are changes to the license_id field
+        page.license = lic
+        rev_id = rev.id
+        self.session.commit()
+        self.session.remove()
+
+        page = self.session.query(Page).filter_by(name=u'home2').one()
+        assert page.revision_id == rev_id
+        assert len(page.all_revisions) == 2
+        latest = page.all_revisions[0]
+        assert latest.revision_id == rev_id
+        assert latest.name == u'home2'
+        assert latest.license_id == page.license_id
+        assert page.license_id is not None
+        self.session.remove()
+
+    def test_03_no_real_change(self):
+        page = self.session.query(Page).filter_by(name=u'home2').one()
+        rev = Revision(author=u'tester')
+        SQLAlchemySession.set_revision(self.session, rev)
+        page.name = u'home2'
+        rev_id = rev.id
+        self.session.commit()
+        self.session.remove()
+        page = self.session.query(Page).filter_by(name=u'home2').one()
+        assert page.revision_id != rev_id
+        assert len(page.all_revisions) == 2
+        self.session.remove()
+
+    def test_04_collection_without_backref(self):
+        page = self.session.query(Page).filter_by(name=u'home2').one()
+        rev = Revision(author=u'tester')
+        SQLAlchemySession.set_revision(self.session, rev)
+        site = Site(name=u'main')
+        site.pages.append(page)
+        self.session.add(site)
+        rev_id = rev.id
+        self.session.commit()
+        self.session.remove()
+        page = self.session.query(Page).filter_by(name=u'home2').one()
+        assert page.site_id is not None
+        assert page.revision_id == rev_id
+        assert len(page.all_revisions) == 3
+        assert page.all_revisions[0].site_id == page.site_id
+
+        site = self.session.query(Site).one()
+        rev = Revision(author=u'tester')
+        SQLAlchemySession.set_revision(self.session, rev)
+        site.pages.remove(site.pages[0])
+        rev_id = rev.id
+        self.session.commit()
+        self.session.remove()
+        page = self.session.query(Page).filter_by(name=u'home2').one()
+        assert page.site_id is None
+        assert page.revision_id == rev_id
+        assert len(page.all_revisions) == 4
+        assert page.all_revisions[0].site_id is None
+        self.session.remove()
@@ -0,0 +1,156 @@
+import threading
+
+from demo import *
+from benchmark import StatementCounter
+import cache
+from cache import LRUCache
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache:
+    def test_get_put(self):
+        lru = LRUCache(maxsize=2)
+        assert lru.get('a') is None
+        assert lru.get('a', 1) == 1
+        lru.put('a', None)
+        assert lru.get('a', 1) is None
+        assert lru.hits == 1 and lru.misses == 2
+
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(maxsize=2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.get('a')
+        lru.put('c', 3)
+        assert len(lru) == 2
+        assert lru.get('b') is None
+        assert lru.get('a') == 1
+        assert lru.get('c') == 3
+
+    def test_ttl(self):
+        timer = FakeTimer()
+        lru = LRUCache(ttl=10, timer=timer)
+        lru.put('a', 1)
+        timer.now = 9
+        assert lru.get('a') == 1
+        timer.now = 10
+        assert lru.get('a') is None
+        assert len(lru) == 0
+
+    def test_invalidate(self):
+        lru = LRUCache()
+        lru.put('a', 1, [('revision', 'r1')])
+        lru.put('b', 2, [('revision', 'r1'), ('revision', 'r2')])
+        lru.put('c', 3, [('revision', 'r2')])
+        lru.invalidate(('revision', 'r1'))
+        assert lru.get('a') is None
+        assert lru.get('b') is None
+        assert lru.get('c') == 3
+        lru.invalidate(('revision', 'r2'))
+        assert len(lru) == 0
+        assert lru._tags == {}
+
+    def test_threads(self):
+        lru = LRUCache(maxsize=50)
+        errors = []
+        def work(num):
+            try:
+                for ii in range(2000):
+                    key = (num, ii % 100)
+                    lru.put(key, ii, [('tag', ii % 7)])
+                    lru.get(key)
+                    if ii % 50 == 0:
+                        lru.invalidate(('tag', ii % 7))
+            except Exception, inst:
+                errors.append(inst)
+        threads = [ threading.Thread(target=work, args=(num,))
+                for num in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == [], errors
+        assert len(lru) <= 50
+
+
+class TestSharedCache:
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        rev1 = repo.new_revision()
+        Session.add(Package(name=u'cached', title=u't1'))
+        repo.commit_and_remove()
+        rev2 = repo.new_revision()
+        Session.query(Package).filter_by(name=u'cached').one().title = u't2'
+        repo.commit_and_remove()
+        self.rev1_id = rev1.id
+        self.rev2_id = rev2.id
+        self.shared = cache.configure(maxsize=100)
+
+    @classmethod
+    def teardown_class(self):
+        cache.disable()
+        Session.remove()
+        repo.rebuild_db()
+
+    def get_as_of_rev1(self):
+        pkg = Session.query(Package).filter_by(name=u'cached').one()
+        rev1 = Session.query(Revision).get(self.rev1_id)
+        counter = StatementCounter(engine)
+        counter.start()
+        pkgr1 = pkg.get_as_of(rev1)
+        counter.stop()
+        return pkgr1, counter
+
+    def test_01_shared_between_sessions(self):
+        pkgr1, counter = self.get_as_of_rev1()
+        assert pkgr1.title == u't1'
+        assert len(counter.on_table('package_revision')) == 1
+        Session.remove()
+        pkgr1, counter = self.get_as_of_rev1()
+        assert counter.statements == [], counter.statements
+        assert pkgr1.title == u't1'
+        assert pkgr1.revision_id == self.rev1_id
+        assert pkgr1 in Session
+        assert pkgr1.continuity.name == u'cached'
+        Session.remove()
+
+    def test_02_purge_invalidates(self):
+        assert len(self.shared) > 0
+        rev2 = Session.query(Revision).get(self.rev2_id)
+        repo.purge_revision(rev2)
+        assert len(self.shared) == 0
+        Session.remove()
+
+    def test_03_later_write_invalidates(self):
+        import datetime
+        revA = repo.new_revision()
+        Session.add(Package(name=u'later', title=u'a'))
+        repo.commit_and_remove()
+        revC = repo.new_revision()
+        Session.add(License(name=u'later'))
+        repo.commit_and_remove()
+        pkg = Session.query(Package).filter_by(name=u'later').one()
+        revC = Session.query(Revision).get(revC.id)
+        assert pkg.get_as_of(revC).title == u'a'
+        Session.remove()
+        # a revision from in between written afterwards
+        revA = Session.query(Revision).get(revA.id)
+        revC = Session.query(Revision).get(revC.id)
+        timestamp = revA.timestamp + (revC.timestamp - revA.timestamp) / 2
+        Session.remove()
+        revB = repo.new_revision()
+        revB.timestamp = timestamp
+        Session.query(Package).filter_by(name=u'later').one().title = u'b'
+        repo.commit_and_remove()
+        pkg = Session.query(Package).filter_by(name=u'later').one()
+        revC = Session.query(Revision).get(revC.id)
+        assert pkg.get_as_of(revC).title == u'b'
+        Session.remove()
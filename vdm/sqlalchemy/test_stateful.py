@@ -133,6 +133,42 @@ class TestStatefulList:
         out = repr(self.slist)
         assert out, out
 
+    def test_positions_follow_changes(self):
+        assert len(self.slist) == 2
+        # through the other list
+        del self.slist_deleted[0]
+        assert len(self.slist) == 3
+        assert self.slist[1] == self.sb
+        self.slist.append(self.se)
+        assert self.slist[-1] == self.se
+        assert len(self.slist_deleted) == 1
+        # behind the lists' back
+        self.sa.delete()
+        assert len(self.slist) == 3
+        assert self.slist[0] == self.sb
+        self.baselist.insert(0, Stateful('x'))
+        assert self.slist[0].name == 'x'
+
+    def test_watch(self):
+        changes = []
+        def watch(slist):
+            changes.append(slist)
+            return lambda: True
+        slist = StatefulList(self.baselist, is_active=is_active, watch=watch)
+        assert len(slist) == 2
+        assert slist[1] == self.baselist[3]
+        assert len(changes) == 1
+        # kept
+        self.sa.delete()
+        assert len(slist) == 2
+        slist.changed()
+        assert len(slist) == 1
+        assert len(changes) == 2
+        # own changes are seen
+        slist.append(self.se)
+        assert slist[-1] == self.se
+        assert len(changes) == 3
+
 class TestStatefulListComplex:
     active = ACTIVE
     deleted = DELETED
@@ -189,6 +225,101 @@ class TestStatefulListComplex:
         assert len(self.slist) == self.startlen
         assert len(self.baselist) == self.startlen_base
 
+    def test___setitem__slice(self):
+        sd = self.baselist[3]
+        self.slist[:] = [Stateful('d'), self.sb, self.se]
+        # existing objects reused (and moved to the end) rather than added
+        assert self.baselist == [self.sa, self.sc, sd, self.sb, self.se], \
+                self.baselist
+        assert list(self.slist) == [sd, self.sb, self.se]
+        assert self.sa.state == self.deleted
+
+    def test___setitem__slice_middle(self):
+        self.slist.extend([self.se, self.sf])
+        self.slist[1:3] = [Stateful('c')]
+        assert [ x.name for x in self.slist ] == ['a', 'c', 'f']
+        assert len(self.baselist) == 6, self.baselist
+
+    def test___setitem__slice_negative(self):
+        self.slist.extend([self.se])
+        self.slist[-1:] = [self.sf]
+        assert [ x.name for x in self.slist ] == ['a', 'd', 'f']
+        assert self.sa.state == self.active
+        self.slist[-5:-2] = [Stateful('x')]
+        assert [ x.name for x in self.slist ] == ['x', 'd', 'f']
+
+    def test___setitem__slice_open_ended(self):
+        self.slist[1:] = [self.se, self.sf]
+        assert [ x.name for x in self.slist ] == ['a', 'e', 'f']
+        self.slist[5:] = [Stateful('g')]
+        assert [ x.name for x in self.slist ] == ['a', 'e', 'f', 'g']
+        self.slist[:1] = []
+        assert [ x.name for x in self.slist ] == ['e', 'f', 'g']
+
+    def test___setitem__extended_slice(self):
+        self.slist.extend([self.se, self.sf])
+        self.slist[::2] = [Stateful('x'), Stateful('y')]
+        assert [ x.name for x in self.slist ] == ['x', 'd', 'y', 'f']
+        try:
+            self.slist[::2] = [self.sa]
+        except ValueError:
+            pass
+        else:
+            assert False, 'should have raised'
+
+    def test_insert_negative(self):
+        self.slist.insert(-1, self.se)
+        assert [ x.name for x in self.slist ] == ['a', 'e', 'd']
+        self.slist.insert(-10, self.sf)
+        self.slist.insert(10, Stateful('g'))
+        assert [ x.name for x in self.slist ] == ['f', 'a', 'e', 'd', 'g']
+        self.slist[-1] = Stateful('h')
+        assert [ x.name for x in self.slist ] == ['f', 'a', 'e', 'd', 'h']
+
+    def test_identity_map_on_change(self):
+        keys = []
+        def identifier(obj):
+            keys.append(obj.name)
+            return obj.name
+        slist = StatefulList(self.baselist, is_active=is_active,
+                identifier=identifier)
+        # reading does not need it
+        assert len(slist) == 2
+        assert slist[1].name == 'd'
+        assert [ x.name for x in slist ] == ['a', 'd']
+        assert keys == []
+        slist.append(Stateful('c'))
+        assert [ x.name for x in slist ] == ['a', 'd', 'c']
+        assert self.baselist[-1] == self.sc
+        assert self.sc.state == self.active
+
+    def test_append_several_existing(self):
+        self.slist.extend([self.se, self.sf])
+        del self.slist[:]
+        # each one moves to the end in turn
+        self.slist.append(Stateful('a'))
+        self.slist.append(Stateful('e'))
+        self.slist.append(Stateful('b'))
+        assert [ x.name for x in self.slist ] == ['a', 'e', 'b']
+        assert self.baselist[-3:] == [self.sa, self.se, self.sb]
+        assert len(self.baselist) == 6
+
+    def test___delitem__slice(self):
+        self.slist.extend([self.se, self.sf])
+        del self.slist[1:3]
+        assert [ x.name for x in self.slist ] == ['a', 'f']
+        assert len(self.baselist) == 6
+
+    def test___delitem__extended_slice(self):
+        for index in [slice(None, None, -1), slice(4, 1, -1),
+                slice(None, None, -2), slice(-1, 0, -3), slice(1, None, 2)]:
+            self.setup()
+            self.slist.extend([self.se, self.sf, Stateful('g')])
+            names = [ x.name for x in self.slist ]
+            del names[index]
+            del self.slist[index]
+            assert [ x.name for x in self.slist ] == names, (index, names)
+
 
 class TestStatefulDict:
     active = ACTIVE
@@ -0,0 +1,151 @@
+from sqlalchemy.orm import mapper, relation
+from sqlalchemy.orm.attributes import instance_state
+from demo import *
+from base import *
+from benchmark import StatementCounter
+
+# stateful m2m filtering on state in SQL (add_stateful_m2m query_backed)
+article_table = Table('article', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('name', UnicodeText),
+        )
+article_tag_table = Table('article_tag', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('article_id', Integer, ForeignKey('article.id')),
+        Column('tag_id', Integer, ForeignKey('tag.id')),
+        )
+make_table_stateful(article_table)
+make_table_stateful(article_tag_table)
+article_revision_table = make_revisioned_table(article_table)
+article_tag_revision_table = make_revisioned_table(article_tag_table)
+
+class Article(RevisionedObjectMixin, StatefulObjectMixin, SQLAlchemyMixin):
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+class ArticleTag(RevisionedObjectMixin, StatefulObjectMixin,
+        SQLAlchemyMixin):
+    def __init__(self, article=None, tag=None, state=None):
+        self.article = article
+        self.tag = tag
+        self.state = state
+
+mapper(Article, article_table, properties={
+    'article_tags':relation(ArticleTag, backref='article', cascade='all'),
+    },
+    extension=Revisioner(article_revision_table)
+    )
+mapper(ArticleTag, article_tag_table, properties={
+    'tag':relation(Tag),
+    },
+    extension=Revisioner(article_tag_revision_table)
+    )
+modify_base_object_mapper(Article, Revision, State)
+modify_base_object_mapper(ArticleTag, Revision, State)
+ArticleRevision = create_object_version(mapper, Article,
+        article_revision_table)
+ArticleTagRevision = create_object_version(mapper, ArticleTag,
+        article_tag_revision_table)
+add_stateful_versioned_m2m(Article, ArticleTag, 'tags', 'tag',
+        'article_tags', query_backed=True)
+
+
+class TestStatefulQuery:
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        repo.new_revision()
+        tags = [ Tag(name=u'tag%s' % ii) for ii in range(10) ]
+        Session.add(Article(id=1, name=u'a'))
+        Session.add_all(tags)
+        repo.commit_and_remove()
+        repo.new_revision()
+        article = Session.query(Article).get(1)
+        article.tags = Session.query(Tag).order_by(Tag.name).all()
+        repo.commit_and_remove()
+        repo.new_revision()
+        # 3 left active
+        article = Session.query(Article).get(1)
+        article.tags = Session.query(Tag).filter(
+                Tag.name.in_([u'tag0', u'tag1', u'tag2'])).all()
+        repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def setup(self):
+        self.article = Session.query(Article).get(1)
+        self.counter = StatementCounter(engine)
+
+    def teardown(self):
+        Session.remove()
+
+    def tag(self, name):
+        return Session.query(Tag).filter_by(name=name).one()
+
+    def names(self):
+        return sorted([ tag.name for tag in self.article.tags ])
+
+    def test_01_read(self):
+        self.counter.start()
+        try:
+            assert len(self.article.tags) == 3
+            assert self.article.tags_active.count() == 3
+            assert self.article.tags_deleted.count() == 7
+            assert len(self.article.tags[1:3]) == 2
+            assert self.article.tags_active[-1].state == State.ACTIVE
+        finally:
+            self.counter.stop()
+        assert 'article_tags' not in instance_state(self.article).dict
+        # deleted join objects never loaded (a negative index is a count and
+        # then a limit)
+        statements = self.counter.on_table('article_tag')
+        assert len(statements) == 6, statements
+        assert 'LIMIT' in statements[3], statements
+        assert self.names() == [u'tag0', u'tag1', u'tag2']
+
+    def test_02_append_undeletes(self):
+        repo.new_revision()
+        self.article.tags.append(self.tag(u'tag5'))
+        self.article.tags.append(Tag(name=u'new'))
+        repo.commit_and_remove()
+        self.article = Session.query(Article).get(1)
+        assert self.names() == [u'new', u'tag0', u'tag1', u'tag2',
+                u'tag5'], self.names()
+        # existing join object reused
+        assert Session.query(ArticleTag).count() == 11
+        assert self.article.tags_deleted.count() == 6
+
+    def test_03_set(self):
+        repo.new_revision()
+        self.article.tags = [self.tag(u'tag0'), self.tag(u'tag7')]
+        repo.commit_and_remove()
+        self.article = Session.query(Article).get(1)
+        assert self.names() == [u'tag0', u'tag7'], self.names()
+        assert Session.query(ArticleTag).count() == 11
+        # same as the loaded collection says
+        assert 'article_tags' not in instance_state(self.article).dict
+        self.article.article_tags
+        assert self.names() == [u'tag0', u'tag7'], self.names()
+        assert len(self.article.tags_deleted) == 9
+
+    def test_04_delete(self):
+        repo.new_revision()
+        del self.article.tags_active[0]
+        repo.commit_and_remove()
+        self.article = Session.query(Article).get(1)
+        assert len(self.article.tags) == 1
+        self.article.article_tags
+        assert len(self.article.tags) == 1
+
+    def test_05_not_at_HEAD(self):
+        rev = Session.query(Revision).order_by(Revision.timestamp).all()[1]
+        SQLAlchemySession.set_revision(Session, rev)
+        SQLAlchemySession.set_not_at_HEAD(Session)
+        # what was there then rather than now
+        assert len(self.article.tags) == 10, self.names()
+        assert 'article_tags' in instance_state(self.article).dict
@@ -0,0 +1,137 @@
+from sqlalchemy.orm import mapper
+from demo import *
+from base import *
+from tools import Repository
+
+# a revision table with the valid time columns
+document_table = Table('document', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('title', UnicodeText),
+        )
+make_table_stateful(document_table)
+document_revision_table = make_revisioned_table(document_table,
+        valid_time=True)
+
+class Document(RevisionedObjectMixin, StatefulObjectMixin, SQLAlchemyMixin):
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+mapper(Document, document_table,
+    extension=Revisioner(document_revision_table)
+    )
+modify_base_object_mapper(Document, Revision, State)
+DocumentRevision = create_object_version(mapper, Document,
+        document_revision_table)
+
+
+class TestValidTime:
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        self.repo = Repository(metadata, Session,
+                versioned_objects=[Document])
+        rev1 = repo.new_revision()
+        Session.add(Document(id=1, title=u'v1'))
+        repo.commit_and_remove()
+        rev2 = repo.new_revision()
+        Session.query(Document).get(1).title = u'v2'
+        Session.add(Document(id=2, title=u'other'))
+        repo.commit_and_remove()
+        # several flushes in one revision
+        rev3 = repo.new_revision()
+        doc = Session.query(Document).get(1)
+        doc.title = u'v3-draft'
+        Session.flush()
+        doc.title = u'v3'
+        repo.commit_and_remove()
+        self.rev_ids = [rev1.id, rev2.id, rev3.id]
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def revisions(self):
+        return [ Session.query(Revision).get(id) for id in self.rev_ids ]
+
+    def chain(self, id):
+        return Session.query(DocumentRevision).filter_by(continuity_id=id
+                ).order_by(DocumentRevision.valid_from).all()
+
+    def test_01_columns(self):
+        rev1, rev2, rev3 = self.revisions()
+        chain = self.chain(1)
+        assert [ r.revision_id for r in chain ] == self.rev_ids
+        assert [ r.title for r in chain ] == [u'v1', u'v2', u'v3']
+        assert [ r.valid_from for r in chain ] == [rev1.timestamp,
+                rev2.timestamp, rev3.timestamp]
+        assert [ r.valid_to for r in chain ] == [rev2.timestamp,
+                rev3.timestamp, None]
+        assert [ r.previous_revision_id for r in chain ] == [None,
+                rev1.id, rev2.id]
+        chain = self.chain(2)
+        assert [ (r.valid_from, r.valid_to) for r in chain ] == [
+                (rev2.timestamp, None)]
+        Session.remove()
+
+    def test_02_get_as_of(self):
+        rev1, rev2, rev3 = self.revisions()
+        doc = Session.query(Document).get(1)
+        assert doc.get_as_of(rev1).title == u'v1'
+        assert doc.get_as_of(rev2).title == u'v2'
+        assert doc.get_as_of(rev3).title == u'v3'
+        other = Session.query(Document).get(2)
+        assert other.get_as_of(rev1) is None
+        assert other.get_as_of(rev3).title == u'other'
+        Session.remove()
+
+    def test_03_get_many_as_of(self):
+        rev1, rev2, rev3 = self.revisions()
+        results = Document.get_many_as_of([1, 2], rev1)
+        assert results[1].title == u'v1'
+        assert results[2] is None
+        results = Document.get_many_as_of([1, 2], rev2)
+        assert results[1].title == u'v2'
+        assert results[2].title == u'other'
+        Session.remove()
+
+    def test_04_diff(self):
+        rev1, rev2, rev3 = self.revisions()
+        doc = Session.query(Document).get(1)
+        diff = doc.diff(rev3)
+        assert diff['title'] == '- v2\n+ v3', diff
+        diff = doc.diff(rev3, rev1)
+        assert diff['title'] == '- v1\n+ v3', diff
+        # not changed in rev2
+        other = Session.query(Document).get(2)
+        assert other.diff(rev3) == {}, other.diff(rev3)
+        Session.remove()
+
+    def test_05_backfill(self):
+        def chains():
+            return [ [ (r.revision_id, r.valid_from, r.valid_to,
+                r.previous_revision_id) for r in self.chain(id) ]
+                for id in [1, 2] ]
+        before = chains()
+        # chunks ending inside and at the end of a chain and just one chunk
+        for chunk_size in [1, 2, 3, 10]:
+            Session.execute(document_revision_table.update().values(
+                valid_from=None, valid_to=None, previous_revision_id=None))
+            Session.commit()
+            assert self.repo.backfill_valid_time(chunk_size=chunk_size) == 4
+            after = chains()
+            assert after == before, (chunk_size, after, before)
+        Session.remove()
+
+    def test_06_purge(self):
+        rev1, rev2, rev3 = self.revisions()
+        self.repo.purge_revision(rev2)
+        chain = self.chain(1)
+        assert [ r.revision_id for r in chain ] == [rev1.id, rev3.id]
+        assert chain[0].valid_to == rev3.timestamp
+        assert chain[1].previous_revision_id == rev1.id
+        doc = Session.query(Document).get(1)
+        assert doc.diff(rev3)['title'] == '- v1\n+ v3'
+        Session.remove()
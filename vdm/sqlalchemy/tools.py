@@ -45,6 +45,128 @@ from sqlalchemy.orm import object_session
 from sqlalchemy import __version__ as sqla_version
 
 from base import SQLAlchemySession, State, Revision
+from base import VersionedClassInfo, RevisionWriteLog, RevisionRowBuffer
+from base import instance_state, make_uuid, has_valid_time
+from base import has_revision_timestamp
+from base import AsOfCache, invalidate_written
+import cache
+from sqlalchemy import select, bindparam, and_, or_
+
+import time
+import itertools
+from contextlib import contextmanager
+import datetime
+from StringIO import StringIO
+
+
+def _column_defaults(table):
+    '''Python side defaults for the columns of `table`.
+
+    @return: dict of column key: default value or callable (taking no
+    arguments) for columns with a scalar or python callable default.
+    '''
+    defaults = {}
+    for col in table.c:
+        default = col.default
+        if default is None or default.is_sequence:
+            continue
+        if default.is_scalar:
+            defaults[col.key] = default.arg
+        elif default.is_callable:
+            # sqlalchemy wraps callables to take an execution context
+            defaults[col.key] = lambda fn=default.arg: fn(None)
+    return defaults
+
+def _check_columns(table, row):
+    unknown = set(row) - set(table.c.keys())
+    if unknown:
+        raise ValueError('Unknown columns for %s: %s' % (table.name,
+            ', '.join(sorted(unknown))))
+
+def _with_defaults(table, row, defaults):
+    '''Copy of `row` with defaults (see _column_defaults) for missing
+    columns.'''
+    colvalues = dict(row)
+    for key in table.c.keys():
+        if key not in colvalues:
+            default = defaults.get(key)
+            if callable(default):
+                default = default()
+            colvalues[key] = default
+    return colvalues
+
+def _copy_value(value):
+    '''Format value for PostgreSQL COPY (text format).'''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return value and 't' or 'f'
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+            '\n', '\\n').replace('\r', '\\r')
+
+def _copy_rows(connection, table, rows):
+    '''Write `rows` (list of dicts) to `table` with COPY (psycopg2 only).'''
+    preparer = connection.dialect.identifier_preparer
+    keys = [ col.key for col in table.c ]
+    buf = StringIO()
+    for row in rows:
+        buf.write('\t'.join([ _copy_value(row[key]) for key in keys ]))
+        buf.write('\n')
+    buf.seek(0)
+    sql = 'COPY %s (%s) FROM STDIN' % (preparer.format_table(table),
+            ', '.join([ preparer.quote(col.name) for col in table.c ]))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(sql, buf)
+    finally:
+        cursor.close()
+
+
+class LargeRevision(object):
+    '''A revision which changes more objects than we want in memory at once.
+
+    Objects added or changed in the revision are flushed every `chunk_size`
+    objects and then expunged from the session, so DO NOT hold on to them.
+    See Repository.large_revision.
+    '''
+    def __init__(self, session, revision, chunk_size):
+        self.session = session
+        self.revision = revision
+        self.chunk_size = chunk_size
+        self.pending = 0
+        self.chunks = 0
+
+    def add(self, obj):
+        '''Add new object `obj` to the revision.'''
+        self.session.add(obj)
+        self.changed()
+
+    def changed(self, obj=None):
+        '''Tell us an object has been changed (or added).'''
+        self.pending += 1
+        if self.pending >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        '''Flush what we have got and clear it out of the session.'''
+        self.session.flush()
+        session = SQLAlchemySession.instance(self.session)
+        for obj in session.identity_map.values():
+            if obj is not self.revision:
+                session.expunge(obj)
+        # the log holds an id for each object revision written
+        RevisionWriteLog.get(session).forget()
+        if self.pending:
+            self.chunks += 1
+        self.pending = 0
+        logger.debug('LargeRevision: flushed chunk %s', self.chunks)
+
 
 class Repository(object):
     '''Manage repository-wide type changes for versioned domain models.
@@ -124,12 +246,70 @@ class Repository(object):
         automatically within a transaction at all times if session was set up
         as transactional (every commit is paired with a begin)
         <http://groups.google.com/group/sqlalchemy/browse_thread/thread/a54ce150b33517db/17587ca675ab3674>
+
+        The revision is only added to the session (and written to the
+        database) by the first flush which changes a versioned object. If
+        nothing versioned is changed it is not written at all.
         '''
         rev = Revision()
-        self.session.add(rev)
         SQLAlchemySession.set_revision(self.session, rev)
         return rev
 
+    @contextmanager
+    def revision(self, author=None, message=None):
+        '''Context manager for making changes in a new revision.
+
+        The revision is the current revision of this repository's session
+        for this context (thread or asyncio task), so many independent
+        revisions can be in progress at once. It is only written by that
+        session: other sessions used meanwhile keep their own revision.
+        Changes are committed at the end (or rolled back if there is an
+        exception)::
+
+            with repo.revision(author=u'me', message=u'Fix title') as rev:
+                pkg.title = u'New title'
+        '''
+        rev = Revision(author=author, message=message)
+        rev.id = make_uuid()
+        session = SQLAlchemySession.instance(self.session)
+        RevisionWriteLog.start(session, rev.id)
+        token = SQLAlchemySession.set_context_revision(rev, session)
+        try:
+            yield rev
+            self.commit()
+        except:
+            self.session.rollback()
+            raise
+        finally:
+            SQLAlchemySession.reset_context_revision(token)
+
+    @contextmanager
+    def large_revision(self, chunk_size=1000):
+        '''Context manager for a new revision changing very many objects.
+
+        Memory use does not grow with the number of objects changed as they
+        are flushed (and removed from the session) a chunk at a time. It all
+        happens in one transaction which is committed at the end (or rolled
+        back if there is an exception)::
+
+            with repo.large_revision(chunk_size=500) as large:
+                large.revision.message = u'Import'
+                for row in rows:
+                    large.add(Package(**row))
+
+        Call `large.changed(obj)` after changing an existing object.
+        '''
+        large = LargeRevision(self.session, self.new_revision(), chunk_size)
+        try:
+            yield large
+            large.flush()
+            self.commit()
+        except:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.remove()
+
     def youngest_revision(self):
         '''Get the youngest (most recent) revision.'''
         q = self.history()
@@ -143,6 +323,53 @@ class Repository(object):
         '''
         return self.session.query(Revision).filter_by(state=State.ACTIVE)
 
+    def iter_history(self, after=None, author=None, state=State.ACTIVE,
+            since=None, until=None, page_size=1000):
+        '''Iterate over revisions oldest first without loading them all.
+
+        Revisions are got a page at a time with keyset pagination (each page
+        is a query for revisions after the last one of the previous page)
+        and each page is streamed from the database (server side cursor
+        where the driver supports it), so memory use does not grow with the
+        length of the history and late pages are as quick as early ones.
+
+        @param after: (timestamp, id) of a revision: start after it (e.g. to
+            carry on where an earlier iteration stopped).
+        @param author: only revisions by this author.
+        @param state: only revisions in this state (None for any state).
+        @param since: only revisions with timestamp >= since.
+        @param until: only revisions with timestamp < until.
+        @return: iterator of revisions.
+        '''
+        q = self.session.query(Revision)
+        if author is not None:
+            q = q.filter(Revision.author == author)
+        if state is not None:
+            q = q.filter(Revision.state == state)
+        if since is not None:
+            q = q.filter(Revision.timestamp >= since)
+        if until is not None:
+            q = q.filter(Revision.timestamp < until)
+        q = q.order_by(Revision.timestamp, Revision.id)
+        while True:
+            page = q
+            if after is not None:
+                after_timestamp, after_id = after
+                page = page.filter(or_(
+                    Revision.timestamp > after_timestamp,
+                    and_(Revision.timestamp == after_timestamp,
+                        Revision.id > after_id)
+                    ))
+            page = page.limit(page_size).yield_per(page_size).\
+                    execution_options(stream_results=True)
+            count = 0
+            for revision in page:
+                count += 1
+                after = (revision.timestamp, revision.id)
+                yield revision
+            if count < page_size:
+                break
+
     def list_changes(self, revision):
         '''List all objects changed by this `revision`.
 
@@ -182,8 +409,11 @@ class Repository(object):
         for o in self.versioned_objects:
             revobj = o.__revision_class__
             items = self.session.query(revobj).filter_by(revision=revision).all()
+            valid_time = has_valid_time(class_mapper(revobj).local_table)
             for item in items:
                 continuity = item.continuity
+                if valid_time:
+                    self._unlink_valid_time(revobj, item)
 
                 if continuity.revision == revision: # need to change continuity
                     trevobjs = self.session.query(revobj).join('revision').  filter(
@@ -200,6 +430,10 @@ class Repository(object):
                 self.session.delete(item)
             for cont in to_purge:
                 self.session.delete(cont)
+        shared = cache.get_cache()
+        if shared is not None:
+            # what objects looked like at any revision since may have changed
+            shared.clear()
         if leave_record:
             import datetime
             revision.message = u'PURGED: %s UTC' % datetime.datetime.utcnow()
@@ -207,6 +441,128 @@ class Repository(object):
             self.session.delete(revision)
         self.commit_and_remove()
 
+    def _unlink_valid_time(self, revobj, item):
+        '''Take object revision `item` (about to be purged) out of the valid
+        time chain: the one before it is valid until item's successor and
+        that successor now follows the one before.'''
+        if item.previous_revision_id is not None:
+            previous = self.session.query(revobj).get(
+                    (item.continuity_id, item.previous_revision_id))
+            if previous is not None:
+                previous.valid_to = item.valid_to
+        nexts = self.session.query(revobj).filter_by(
+                continuity_id=item.continuity_id,
+                previous_revision_id=item.revision_id).all()
+        for next_ in nexts:
+            next_.previous_revision_id = item.previous_revision_id
+
+    def backfill_valid_time(self, classes=None, chunk_size=1000):
+        '''Fill in valid_from, valid_to and previous_revision_id for
+        revision tables made with valid_time=True (see
+        make_revisioned_table) which already hold object revisions, e.g.
+        after adding the columns to an existing database.
+
+        NB: commits.
+
+        @param classes: versioned classes to backfill (default: all
+            versioned_objects with the valid time columns).
+        @param chunk_size: number of object revisions read (and updated) at
+            a time.
+        @return: number of object revisions updated.
+        '''
+        if classes is None:
+            classes = self.versioned_objects
+        revision_mapper = class_mapper(Revision)
+        revision_table = revision_mapper.local_table
+        connection = self.session.connection(mapper=revision_mapper)
+        count = 0
+        for cls in classes:
+            table = class_mapper(cls.__revision_class__).local_table
+            if not has_valid_time(table):
+                continue
+            c = table.c
+            update = table.update().where(
+                    c.continuity_id == bindparam('_continuity_id')).where(
+                    c.revision_id == bindparam('_revision_id'))
+            timestamp_col = revision_table.c.timestamp
+            q = select([c.continuity_id, c.revision_id, timestamp_col]).where(
+                    c.revision_id == revision_table.c.id).order_by(
+                    c.continuity_id, timestamp_col, c.revision_id)
+            params = []
+            last = None
+            after = None
+            while True:
+                # a chunk at a time (keyset pagination as in iter_history)
+                # so memory use does not grow with the length of the history
+                page = q
+                if after is not None:
+                    after_cid, after_rid, after_timestamp = after
+                    page = page.where(or_(
+                        c.continuity_id > after_cid,
+                        and_(c.continuity_id == after_cid, or_(
+                            timestamp_col > after_timestamp,
+                            and_(timestamp_col == after_timestamp,
+                                c.revision_id > after_rid)))
+                        ))
+                rows = connection.execute(page.limit(chunk_size)).fetchall()
+                for continuity_id, revision_id, timestamp in rows:
+                    if last is not None and \
+                            last['_continuity_id'] == continuity_id:
+                        last['valid_to'] = timestamp
+                        previous_revision_id = last['_revision_id']
+                    else:
+                        previous_revision_id = None
+                    last = {'_continuity_id': continuity_id,
+                            '_revision_id': revision_id,
+                            'valid_from': timestamp,
+                            'valid_to': None,
+                            'previous_revision_id': previous_revision_id,
+                            }
+                    params.append(last)
+                # keep the last one as its valid_to may change
+                if len(params) > 1:
+                    connection.execute(update, params[:-1])
+                    count += len(params) - 1
+                    params = params[-1:]
+                if len(rows) < chunk_size:
+                    break
+                after = tuple(rows[-1])
+            if params:
+                connection.execute(update, params)
+                count += len(params)
+        self.commit()
+        return count
+
+    def backfill_revision_timestamp(self, classes=None):
+        '''Fill in revision_timestamp of object revisions which do not have
+        it (see make_revisioned_table), e.g. after adding the column to an
+        existing database.
+
+        NB: commits.
+
+        @param classes: versioned classes to backfill (default: all
+            versioned_objects with a revision_timestamp column).
+        @return: number of object revisions updated.
+        '''
+        if classes is None:
+            classes = self.versioned_objects
+        revision_mapper = class_mapper(Revision)
+        revision_table = revision_mapper.local_table
+        connection = self.session.connection(mapper=revision_mapper)
+        count = 0
+        for cls in classes:
+            table = class_mapper(cls.__revision_class__).local_table
+            if not has_revision_timestamp(table):
+                continue
+            timestamp = select([revision_table.c.timestamp]).where(
+                    revision_table.c.id == table.c.revision_id).as_scalar()
+            result = connection.execute(table.update().where(
+                table.c.revision_timestamp == None).values(
+                revision_timestamp=timestamp))
+            count += result.rowcount
+        self.commit()
+        return count
+
     def revert(self, continuity, new_correct_revobj):
         '''Revert continuity object back to a particular revision_object.
 
@@ -214,6 +570,12 @@ class Repository(object):
         '''
         logger.debug('revert: %s' % continuity)
         table = class_mapper(continuity.__class__).mapped_table
+        shared = cache.get_cache()
+        if shared is not None:
+            revision_table = class_mapper(
+                    continuity.__revision_class__).local_table
+            shared.invalidate(('continuity', revision_table.name,
+                continuity.id))
         # TODO: ? this will only set columns and not mapped attribs
         # TODO: need to do this directly on table or disable
         # revisioning behaviour ...
@@ -226,3 +588,198 @@ class Repository(object):
         logger.debug(object_session(continuity))
         logger.debug(self.session)
 
+
+    def _bulk_setup(self, cls, revision):
+        info = VersionedClassInfo.get(cls)
+        if info is None:
+            raise ValueError('%s is not a versioned class' % cls)
+        if revision is None:
+            revision = SQLAlchemySession.get_revision(self.session)
+        if revision is None:
+            raise ValueError('No revision given or set on the session')
+        return info, revision
+
+    def _write_revision(self, revision):
+        '''Make sure `revision` is in the database before we write object
+        revisions for it.'''
+        if instance_state(revision).key is None:
+            self.session.add(revision)
+            self.session.flush()
+
+    def bulk_load(self, cls, rows, revision=None, chunk_size=1000,
+            use_copy=None):
+        '''Load lots of new versioned objects of class `cls` in bulk.
+
+        This bypasses the ORM (and the Revisioner) entirely: the rows for the
+        continuity table and the revision table are written together, a chunk
+        at a time, with executemany (or COPY on PostgreSQL with psycopg2). Use
+        it for initial imports of large amounts of data.
+
+        NB: writes in the session's transaction but does *not* commit.
+
+        @param rows: iterable of dicts of column values (keyed by column key).
+            Missing columns get their (python side) defaults, and state is
+            active unless given. The primary key must be given or come from
+            a python side default.
+        @param revision: revision to load objects in (defaults to the
+            session's current revision).
+        @param use_copy: use COPY (default: if the database supports it).
+        @return: dict of statistics (objects, chunks, seconds, rate).
+        '''
+        info, revision = self._bulk_setup(cls, revision)
+        # we write rows the session's write log does not know about
+        session = SQLAlchemySession.instance(self.session)
+        log = RevisionWriteLog.get(session)
+        if log.revision_id == revision.id:
+            log.complete = False
+
+        connection = self.session.connection(mapper=class_mapper(cls))
+        if use_copy is None:
+            use_copy = connection.dialect.driver == 'psycopg2'
+        table = info.table
+        revision_table = info.revision_table
+        defaults = _column_defaults(table)
+
+        def normalize(row):
+            _check_columns(table, row)
+            colvalues = _with_defaults(table, row, defaults)
+            if colvalues[info.primary_key] is None:
+                raise ValueError('No primary key for %s row: %s' % (
+                    table.name, row))
+            colvalues['revision_id'] = revision.id
+            return colvalues
+
+        stats = {'objects': 0, 'chunks': 0}
+        start = time.time()
+        rows = iter(rows)
+        while True:
+            chunk = [ normalize(row)
+                    for row in itertools.islice(rows, chunk_size) ]
+            if not chunk:
+                break
+            self._write_revision(revision)
+            revision_rows = []
+            for colvalues in chunk:
+                revcolvalues = dict(colvalues)
+                revcolvalues['continuity_id'] = colvalues[info.primary_key]
+                if info.valid_time:
+                    # all new objects so nothing to replace
+                    revcolvalues['valid_from'] = revision.timestamp
+                    revcolvalues['valid_to'] = None
+                    revcolvalues['previous_revision_id'] = None
+                if info.revision_timestamp:
+                    revcolvalues['revision_timestamp'] = revision.timestamp
+                revision_rows.append(revcolvalues)
+            if use_copy:
+                _copy_rows(connection, table, chunk)
+                _copy_rows(connection, revision_table, revision_rows)
+            else:
+                connection.execute(table.insert(), chunk)
+                connection.execute(info.statements.insert, revision_rows)
+            # as the flush does for the object revisions it writes
+            invalidate_written(revision_table, [
+                (revcolvalues['continuity_id'], revision.id)
+                for revcolvalues in revision_rows ])
+            AsOfCache.discard(session)
+            stats['objects'] += len(chunk)
+            stats['chunks'] += 1
+            logger.info('bulk_load: %s %s rows (%.0f rows/s)', table.name,
+                    stats['objects'],
+                    stats['objects'] / max(time.time() - start, 1e-6))
+        stats['seconds'] = time.time() - start
+        stats['rate'] = stats['objects'] / max(stats['seconds'], 1e-6)
+        return stats
+
+    def bulk_sync(self, cls, rows, revision=None, chunk_size=1000):
+        '''Bring versioned objects of class `cls` in line with `rows`.
+
+        For each row the existing object (matched on primary key) is updated
+        if any of the columns given in the row differ from what is in the
+        database, and created if it does not exist. Rows which match what is
+        already there are skipped: no continuity update and no object
+        revision. Like bulk_load this bypasses the ORM and works a chunk of
+        rows at a time (one SELECT per chunk to get the existing rows).
+
+        NB: writes in the session's transaction but does *not* commit. Objects
+        already loaded in the session are not refreshed.
+
+        @param rows: iterable of dicts of column values which must include the
+            primary key. Columns not given are left as they are (or get their
+            defaults for new objects).
+        @return: dict with counts of inserted, updated and unchanged rows.
+        '''
+        info, revision = self._bulk_setup(cls, revision)
+        session = SQLAlchemySession.instance(self.session)
+        log = RevisionWriteLog.get(session)
+        connection = self.session.connection(mapper=class_mapper(cls))
+        table = info.table
+        pkcol = table.c[info.primary_key]
+        # columns which are compared (a change to revision_id alone is no
+        # change at all)
+        compared = [ key for key in table.c.keys() if key != 'revision_id' ]
+        defaults = _column_defaults(table)
+        update = table.update().where(pkcol == bindparam('_pk'))
+
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            incoming = {}
+            for row in chunk:
+                _check_columns(table, row)
+                if row.get(info.primary_key) is None:
+                    raise ValueError('No primary key for %s row: %s' % (
+                        table.name, row))
+                # last one wins if a key is given more than once
+                incoming[row[info.primary_key]] = row
+            q = select([table]).where(pkcol.in_(incoming.keys()))
+            current = dict([ (row[pkcol], dict(row))
+                for row in connection.execute(q) ])
+
+            inserts = []
+            updates = []
+            for pk, row in incoming.items():
+                existing = current.get(pk)
+                if existing is None:
+                    colvalues = _with_defaults(table, row, defaults)
+                    colvalues['revision_id'] = revision.id
+                    inserts.append(colvalues)
+                    continue
+                keys = [ key for key in compared if key in row ]
+                if tuple([ row[key] for key in keys ]) == \
+                        tuple([ existing[key] for key in keys ]):
+                    counts['unchanged'] += 1
+                    continue
+                colvalues = dict(existing)
+                colvalues.update(row)
+                colvalues['revision_id'] = revision.id
+                updates.append(colvalues)
+
+            if not (inserts or updates):
+                continue
+            self._write_revision(revision)
+            buf = RevisionRowBuffer()
+            if inserts:
+                connection.execute(table.insert(), inserts)
+            if updates:
+                params = []
+                for colvalues in updates:
+                    params.append(dict(colvalues,
+                        _pk=colvalues[info.primary_key]))
+                connection.execute(update, params)
+            for colvalues in inserts + updates:
+                revcolvalues = dict(colvalues)
+                revcolvalues['continuity_id'] = colvalues[info.primary_key]
+                if info.valid_time:
+                    revcolvalues['valid_from'] = revision.timestamp
+                if info.revision_timestamp:
+                    revcolvalues['revision_timestamp'] = revision.timestamp
+                buf.add(info.revision_table, connection, revcolvalues)
+            buf.write(log)
+            AsOfCache.discard(session)
+            counts['inserted'] += len(inserts)
+            counts['updated'] += len(updates)
+        logger.info('bulk_sync: %s %s', table.name, counts)
+        return counts